@@ -2,9 +2,16 @@ import collections
 import contextlib
 import datetime
 import functools
+import heapq
+import itertools
+import operator
 import re
+import threading
+import time
 from abc import ABCMeta, abstractmethod
 
+from . import datastream
+
 
 # Exceptions
 
@@ -21,12 +28,21 @@ class ItemError(DatabaseError):  # (i.e. KeyError) must be subclass of DatabaseE
     notExistingTxt = "Item does not exist"
     alreadyExistingTxt = "Item does already exist"
 
-    def __init__(self, itemId, msg=None):
+    def __init__(self, itemId, msg=None, itemIds=None):
+        """:param itemIds: all offending ids (of a bulk operation), itemId is the first of them"""
         DatabaseError.__init__(self)
         self.itemId = itemId
+        self.itemIds = [itemId] if itemIds is None else list(itemIds)
         self.msg = msg
 
+    @classmethod
+    def forIds(cls, itemIds, msg=None):
+        """Returns an ItemError for one or more offending ids"""
+        return cls(itemIds[0], msg, itemIds)
+
     def __str__(self):
+        if len(self.itemIds) > 1:
+            return "ItemIds {itemIds}: {msg}".format(itemIds=", ".join(map(str, self.itemIds)), msg=self.msg)
         return "ItemId {itemId}: {msg}".format(itemId=self.itemId, msg=self.msg)
 
 
@@ -35,9 +51,12 @@ class ItemError(DatabaseError):  # (i.e. KeyError) must be subclass of DatabaseE
 
 # noinspection PyMethodMayBeStatic
 class Attribute(object, metaclass=ABCMeta):
-    def __init__(self, default):
+    def __init__(self, default, index=False, unique=False):
         self.default = default
         self.intern_default = default
+        self.name = None  # Assigned by the EntityMeta
+        self.index = index or unique  # Engines maintain an index for fast lookups (see ItemContainer.findBy)
+        self.unique = unique
 
     def reprValue(self, value):
         return str(value)
@@ -45,14 +64,66 @@ class Attribute(object, metaclass=ABCMeta):
     def lessThan(self, v1, v2):  # v1 less than v2 -> True
         return v1 < v2
 
+    def internValue(self, value):
+        """Returns the value as it is stored by the engines"""
+        return value
+
+    # Query expressions (see Expression)
+
+    def __eq__(self, other):
+        return Comparison(self, "==", other)
+
+    def __ne__(self, other):
+        return Comparison(self, "!=", other)
+
+    def __lt__(self, other):
+        return Comparison(self, "<", other)
+
+    def __le__(self, other):
+        return Comparison(self, "<=", other)
+
+    def __gt__(self, other):
+        return Comparison(self, ">", other)
+
+    def __ge__(self, other):
+        return Comparison(self, ">=", other)
+
+    def isIn(self, values):
+        return Comparison(self, "in", tuple(values))
+
+    def __and__(self, other):
+        return asExpression(self) & other
+
+    def __or__(self, other):
+        return asExpression(self) | other
+
+    def __invert__(self):
+        return ~asExpression(self)
+
+    __hash__ = object.__hash__
+
+    def write(self, device, value):
+        raise NotImplementedError("Attribute {} cannot be serialized".format(type(self).__name__))
+
+    def read(self, device):
+        raise NotImplementedError("Attribute {} cannot be serialized".format(type(self).__name__))
+
 
 class IntAttribute(Attribute):
     Int8, Int16, Int32, Int64 = range(4)
+    _writers = (datastream.writeInt8, datastream.writeInt16, datastream.writeInt32, datastream.writeInt64)
+    _readers = (datastream.readInt8, datastream.readInt16, datastream.readInt32, datastream.readInt64)
 
-    def __init__(self, default, size=Int16):
-        Attribute.__init__(self, default)
+    def __init__(self, default, size=Int16, index=False, unique=False):
+        Attribute.__init__(self, default, index, unique)
         self.size = size
 
+    def write(self, device, value):
+        IntAttribute._writers[self.size](device, value)
+
+    def read(self, device):
+        return IntAttribute._readers[self.size](device)
+
 
 class IdAttribute(IntAttribute):  # Id
     def __init__(self):
@@ -60,36 +131,91 @@ class IdAttribute(IntAttribute):  # Id
 
 
 class BoolAttribute(Attribute):
-    pass
+    def write(self, device, value):
+        datastream.writeBool(device, value)
+
+    def read(self, device):
+        return datastream.readBool(device)
 
 
 class FloatAttribute(Attribute):
     Single, Double = range(2)
 
-    def __init__(self, default, size=Single):
-        Attribute.__init__(self, default)
+    def __init__(self, default, size=Single, index=False, unique=False):
+        Attribute.__init__(self, default, index, unique)
         self.size = size
 
+    def write(self, device, value):
+        if self.size == FloatAttribute.Double:
+            datastream.writeDouble(device, value)
+        else:
+            datastream.writeFloat(device, value)
+
+    def read(self, device):
+        if self.size == FloatAttribute.Double:
+            return datastream.readDouble(device)
+        return datastream.readFloat(device)
+
 
 class StringAttribute(Attribute):
-    pass
+    def write(self, device, value):
+        datastream.writeString(device, value)
+
+    def read(self, device):
+        return datastream.readString(device)
 
 
 class BlobAttribute(Attribute):
-    pass
+    def write(self, device, value):
+        datastream.writeBlob(device, value)
+
+    def read(self, device):
+        return bytes(datastream.readBlob(device))
 
 
 class DateTimeAttribute(Attribute):
-    pass
+    def write(self, device, value):
+        datastream.writeDateTime(device, value)
+
+    def read(self, device):
+        return datastream.readDateTime(device)
 
 
 class ReferenceAttribute(IdAttribute):
-    def __init__(self, entityCls):
+    # Write policies: what happens to an already stored referenced item when the referencing item is written
+    STORE_ID_ONLY = "store-id-only"  # Only its id is stored
+    CASCADE_IF_DIRTY = "cascade-if-dirty"  # It is written as well, if it was changed since it was loaded
+    CASCADE_ALWAYS = "cascade-always"  # It is always written as well (completely)
+    writePolicies = (STORE_ID_ONLY, CASCADE_IF_DIRTY, CASCADE_ALWAYS)
+
+    def __init__(self, entityCls, lazy=False, index=False, unique=False, writePolicy=STORE_ID_ONLY):
         IdAttribute.__init__(self)
+        if writePolicy not in self.writePolicies:
+            raise ValueError("Unknown write policy {!r}, use one of {}".format(writePolicy, self.writePolicies))
         self.entityCls = entityCls  # The entity it references
+        self.lazy = lazy  # If True, items are read with an EntityRef instead of the referenced item
+        self.writePolicy = writePolicy  # New (not yet added) referenced items are always added
+        self.index = index or unique
+        self.unique = unique
         self.default = None
         self.intern_default = -1
 
+    def internValue(self, value):
+        if value is None or isinstance(value, int):
+            return value
+        return value.id
+
+    def write(self, device, value):  # Only the id is serialized, the container resolves it again
+        if value is None:
+            value = self.intern_default
+        elif not isinstance(value, int):
+            value = value.id
+        IdAttribute.write(self, device, value)
+
+    def read(self, device):
+        value = IdAttribute.read(self, device)
+        return None if value == self.intern_default else value
+
 
 # class ListAttribute(BlobAttribute):
 # 	def __init__(self, itemsType, default):
@@ -108,10 +234,236 @@ class ReferenceAttribute(IdAttribute):
 # 		return value
 
 
+# Query expressions
+
+
+class Expression(object):
+    """A declarative condition on the attributes of an entity
+
+    Expressions are built from the attributes of an entity class, e.g.
+    (Vote.vote_group == grp) & Vote.valid; mind the parentheses, since & and |
+    bind more tightly than comparisons in python. SQL engines compile them to
+    a WHERE clause, the others evaluate them on the items.
+    Both follow SQL for None (NULL): a comparison with None is never true,
+    except for the tests attribute == None and attribute != None.
+    """
+
+    def evaluate(self, item):
+        raise NotImplementedError()
+
+    def toSql(self, params, placeholder="?"):
+        """Returns the sql condition and appends its parameters to params"""
+        raise NotImplementedError()
+
+    def __and__(self, other):
+        return And(self, asExpression(other))
+
+    def __or__(self, other):
+        return Or(self, asExpression(other))
+
+    def __invert__(self):
+        return Not(self)
+
+    def __bool__(self):
+        raise TypeError("Expressions have no truth value, use &, | and ~ instead of and, or and not")
+
+
+class Comparison(Expression):
+    _ops = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "in": lambda value, values: value in values,
+    }
+    _sqlOps = {"==": "=", "!=": "<>", "<": "<", "<=": "<=", ">": ">", ">=": ">=", "in": "IN"}
+
+    def __init__(self, attribute, op, value):
+        self.attribute = attribute
+        self.op = op
+        if op == "in":
+            self.value = tuple(attribute.internValue(val) for val in value)
+        elif isinstance(value, Attribute):
+            self.value = value
+        else:
+            self.value = attribute.internValue(value)
+
+    def evaluate(self, item):
+        value = self.attribute.internValue(getattr(item, self.attribute.name))
+        if self.value is None and self.op in ("==", "!="):
+            return (value is None) == (self.op == "==")
+        if value is None or self.value is None:  # Like NULL in sql
+            return False
+        return self._ops[self.op](value, self.value)
+
+    def toSql(self, params, placeholder="?"):
+        name = self.attribute.name
+        if self.value is None and self.op in ("==", "!="):
+            return "{} IS {}NULL".format(name, "" if self.op == "==" else "NOT ")
+        if self.op == "in":
+            params.extend(self.value)
+            return "{} IN ({})".format(name, ", ".join([placeholder] * len(self.value)) or "NULL")
+        params.append(self.value)
+        return "{} {} {}".format(name, self._sqlOps[self.op], placeholder)
+
+    def __bool__(self):  # So comparing attributes themselves (e.g. in lists) still works
+        if isinstance(self.value, Attribute) and self.op in ("==", "!="):
+            return (self.attribute is self.value) == (self.op == "==")
+        return Expression.__bool__(self)
+
+
+class And(Expression):
+    def __init__(self, *expressions):
+        self.expressions = expressions
+
+    def evaluate(self, item):
+        return all(expression.evaluate(item) for expression in self.expressions)
+
+    def toSql(self, params, placeholder="?"):
+        return "(" + " AND ".join(expression.toSql(params, placeholder) for expression in self.expressions) + ")"
+
+
+class Or(Expression):
+    def __init__(self, *expressions):
+        self.expressions = expressions
+
+    def evaluate(self, item):
+        return any(expression.evaluate(item) for expression in self.expressions)
+
+    def toSql(self, params, placeholder="?"):
+        return "(" + " OR ".join(expression.toSql(params, placeholder) for expression in self.expressions) + ")"
+
+
+class Not(Expression):
+    def __init__(self, expression):
+        self.expression = expression
+
+    def evaluate(self, item):
+        return not self.expression.evaluate(item)
+
+    def toSql(self, params, placeholder="?"):
+        # NOT NULL is NULL in sql, i.e. false again; evaluate() negates the comparisons with None though
+        return "NOT COALESCE(" + self.expression.toSql(params, placeholder) + ", FALSE)"
+
+
+def asExpression(obj):
+    """Converts obj to an Expression; a bare (boolean) attribute means 'attribute is True'"""
+    if isinstance(obj, Expression):
+        return obj
+    if isinstance(obj, Attribute):
+        return Comparison(obj, "==", True)
+    raise TypeError("Cannot use {} as an expression".format(type(obj).__name__))
+
+
+def asFilter(check):
+    """Converts a bare (boolean) attribute to an Expression, leaves Expressions and callables as they are"""
+    if isinstance(check, Attribute):
+        return asExpression(check)
+    return check
+
+
+def makePredicate(check):
+    """Returns a callable for check, which is either an Expression (or a bare attribute) or a callable itself"""
+    check = asFilter(check)
+    if isinstance(check, Expression):
+        return check.evaluate
+    return check
+
+
 # Entity API
 
 
+def _compileFunc(funcName, source, namespace):
+    exec(source, namespace)
+    func = namespace[funcName]
+    func.__generated__ = True
+    return func
+
+
+# The generated functions only know the attributes of the class they were generated for;
+# when called for a subclass (e.g. via Entity.__init__(self, ...)) they delegate to the generic ones
+
+
+def _makeInit(cls):
+    """Generates an __init__ which assigns every attribute directly (in attribute order)"""
+    namespace = {"_cls": cls, "_generic": AbstractEntity.__init__}
+    args, body = [], []
+    for i, (name, attr) in enumerate(cls.attributes.items()):
+        namespace["_default{}".format(i)] = attr.default
+        args.append("{name}=_default{i}".format(name=name, i=i))
+        body.append("    self.{name} = {name}".format(name=name))
+    body.append("    self._loaded = None")
+    source = (
+        "def __init__(self, {args}**kwargs):\n"
+        "    if self.__class__ is not _cls:\n"
+        "        return _generic(self, {passArgs}**kwargs)\n"
+        "    if kwargs:\n"
+        "        raise AttributeError('No such arguments: {{}}'.format(tuple(kwargs.keys())))\n"
+        "{body}\n"
+        "    self.validate()\n"
+    ).format(
+        args="*, " + ", ".join(args) + ", " if args else "",
+        passArgs="".join("{name}={name}, ".format(name=name) for name in cls.attributes),
+        body="\n".join(body),
+    )
+    return _compileFunc("__init__", source, namespace)
+
+
+def _makeReadItem(cls):
+    """Generates a readItem classmethod reading all attributes in one constructor call"""
+    namespace = {"_cls": cls, "_generic": AbstractEntity.readItem.__func__}
+    kwargs = []
+    for i, (name, attr) in enumerate(cls.attributes.items()):
+        namespace["_read{}".format(i)] = attr.read
+        kwargs.append("{name}=_read{i}(device)".format(name=name, i=i))  # kwargs are evaluated in order
+    source = (
+        "def readItem(cls, device):\n"
+        "    if cls is not _cls:\n"
+        "        return _generic(cls, device)\n"
+        "    return cls({})\n"
+    ).format(", ".join(kwargs))
+    return classmethod(_compileFunc("readItem", source, namespace))
+
+
+def _makeWriteItem(cls):
+    """Generates a writeItem classmethod writing all attributes without a loop"""
+    namespace = {"_cls": cls, "_generic": AbstractEntity.writeItem.__func__}
+    body = []
+    for i, (name, attr) in enumerate(cls.attributes.items()):
+        namespace["_write{}".format(i)] = attr.write
+        body.append("    _write{i}(device, item.{name})".format(name=name, i=i))
+    lines = [
+        "def writeItem(cls, device, item):",
+        "    if cls is not _cls:",
+        "        return _generic(cls, device, item)",
+    ]
+    source = "\n".join(lines + body) + "\n"
+    return classmethod(_compileFunc("writeItem", source, namespace))
+
+
+def _makeMarkClean(cls):
+    """Generates a markClean which snapshots all attributes in one tuple"""
+    namespace = {"_cls": cls, "_generic": AbstractEntity.markClean}
+    values = ["self.{name}".format(name=name) for name in cls.attributes]
+    source = (
+        "def markClean(self):\n"
+        "    if self.__class__ is not _cls:\n"
+        "        return _generic(self)\n"
+        "    self._loaded = ({})\n"
+    ).format("".join(value + ", " for value in values))
+    return _compileFunc("markClean", source, namespace)
+
+
 class EntityMeta(type):
+    _generators = (
+        ("__init__", _makeInit),
+        ("readItem", _makeReadItem),
+        ("writeItem", _makeWriteItem),
+        ("markClean", _makeMarkClean),
+    )
+
     def __new__(mcs, name, bases, attrs):
         attributes = {}  # unsorted
         for base in reversed(bases):  # Reversed, so the base on the left has the final say
@@ -120,18 +472,40 @@ class EntityMeta(type):
         attrs_ = attrs.copy()
         for name_, value in attrs.items():
             if isinstance(value, Attribute):
+                value.name = name_
                 attributes[name_] = value
                 del attrs_[name_]  # So the "class variables" (=static vars) don't conflict with the Attributes
         attrs_["attributes"] = collections.OrderedDict()
         attrs_["attributes"].update(sorted(attributes.items(), key=lambda item: item[0]))
-        attrs_["__slots__"] = tuple(attributes.keys())
+        attrs_["__slots__"] = tuple(attributes.keys()) + tuple(attrs.get("__slots__", ()))
         if "__realName__" not in attrs_:
             attrs_["__realName__"] = name.lower() + "s"
         if not re.fullmatch(r"\w+", attrs_["__realName__"]):
             raise NameError("Name may only contain characters A-Z, a-z, 0-9 and '_'")
         if "__containerName__" not in attrs_:
             attrs_["__containerName__"] = attrs_["__realName__"]
-        return type.__new__(mcs, name, bases, attrs_)
+        # Indexes over several attributes, e.g. __indexes__ = (("valid", "vote1"),); single ones via index=True
+        for index in attrs_.get("__indexes__", ()):
+            for attrName in index:
+                if attrName not in attributes:
+                    raise AttributeError("Index {} of {}: unknown attribute {}".format(index, name, attrName))
+        cls = type.__new__(mcs, name, bases, attrs_)
+        for funcName, generator in mcs._generators:
+            if mcs._isReplaceable(cls, funcName, attrs):
+                setattr(cls, funcName, generator(cls))
+        return cls
+
+    @staticmethod
+    def _isReplaceable(cls, funcName, attrs):
+        """Only the generic (or generated) implementations may be replaced by specialized ones"""
+        if funcName in attrs:
+            return False
+        for klass in cls.__mro__[1:]:
+            if funcName in klass.__dict__:
+                func = klass.__dict__[funcName]
+                func = getattr(func, "__func__", func)
+                return klass is AbstractEntity or getattr(func, "__generated__", False)
+        return False
 
     def __getattribute__(self, item):
         if item in type.__getattribute__(self, "attributes").keys():
@@ -140,9 +514,13 @@ class EntityMeta(type):
 
 
 class AbstractEntity(object, metaclass=EntityMeta):
-    __slots__ = ()
+    __slots__ = ("_loaded",)  # Snapshot of the (intern) values as loaded/stored last, None if unknown
+    __indexes__ = ()
     attributes = {}
 
+    # Generic implementations of __init__, writeItem, readItem and markClean;
+    # EntityMeta replaces them with specialized (unrolled) ones for every subclass
+
     def __init__(self, **kwargs):
         if len(kwargs) > len(self.__class__.attributes):
             raise AttributeError("Too many arguments")
@@ -154,6 +532,7 @@ class AbstractEntity(object, metaclass=EntityMeta):
             setattr(self, name, attr.default)
         if kwargs:
             raise AttributeError("No such arguments: {}".format(tuple(kwargs.keys())))
+        self._loaded = None
         self.validate()
 
     def validate(self):
@@ -172,10 +551,38 @@ class AbstractEntity(object, metaclass=EntityMeta):
             setattr(item, name, field.read(device))
         return item
 
+    def markClean(self):
+        """Remembers the current values as the stored ones (engines call this for loaded or written items)"""
+        self._loaded = tuple(getattr(self, name) for name in self.__class__.attributes)
+
+    def markDirty(self):
+        """Forgets the snapshot, so the next setItem writes all attributes"""
+        self._loaded = None
+
+    def dirtyFields(self):
+        """Returns the names of all attributes which were changed since the item was loaded
+
+        :return: a tuple of attribute names (all of them if the item was not loaded from an engine)
+        """
+        attributes = self.__class__.attributes
+        if self._loaded is None:
+            return tuple(attributes.keys())
+        return tuple(
+            name
+            for (name, attr), loaded in zip(attributes.items(), self._loaded)
+            if attr.internValue(getattr(self, name)) != attr.internValue(loaded)  # References compare by id
+        )
+
+    def isDirty(self):
+        return bool(self.dirtyFields())
+
     def copy(self, **kwargs):
+        """Returns a copy with some values replaced; the copy keeps the snapshot, so it still knows what's dirty"""
         kws = {name: getattr(self, name) for name in self.__class__.attributes}
         kws.update(kwargs)
-        return self.__class__(**kws)
+        item = self.__class__(**kws)
+        item._loaded = self._loaded
+        return item
 
     def __repr__(self):
         return "{}: {}".format(
@@ -186,6 +593,10 @@ class AbstractEntity(object, metaclass=EntityMeta):
         return repr(self)
 
     def __eq__(self, other):
+        if isinstance(other, EntityRef):  # Symmetric to EntityRef.__eq__
+            return other == self
+        if not isinstance(other, AbstractEntity):
+            return NotImplemented
         if not isinstance(other, self.__class__):
             raise TypeError("Cannot compare different entities")
         for attribute in self.__class__.attributes.keys():
@@ -198,6 +609,89 @@ class Entity(AbstractEntity):
     id = IdAttribute()
 
 
+class EntityRef(object):
+    """A lazy reference to an item of a container
+
+    The id is available without any I/O; the referenced item is loaded (once)
+    as soon as any other attribute is accessed
+    """
+
+    __slots__ = ("_container", "_id", "_item")
+
+    def __init__(self, container, itemId):
+        self._container = container
+        self._id = itemId
+        self._item = None
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def container(self):
+        return self._container
+
+    @property
+    def item(self):
+        """Returns the referenced item, loading it if necessary"""
+        if self._item is None:
+            self._item = self._container.getItem(self._id)
+        return self._item
+
+    def isLoaded(self):
+        return self._item is not None
+
+    def __getattr__(self, name):  # Only called for names which are not found on the reference itself
+        return getattr(self.item, name)
+
+    def __eq__(self, other):
+        if isinstance(other, EntityRef):
+            return self._container is other._container and self._id == other._id
+        if isinstance(other, AbstractEntity):
+            return self.item == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self._container.entityCls.__realName__, self._id))
+
+    def __repr__(self):
+        return "{}: <ref {}>".format(self._container.entityCls.__name__, self._id)
+
+    def __str__(self):
+        return str(self.item)
+
+
+class ItemIterator(object):
+    """An iterator over streamed items, which can be closed before it is exhausted"""
+
+    __slots__ = ("_rows", "_items")
+
+    def __init__(self, rows, items):
+        """:param rows: the generator reading from the engine
+        :param items: the iterator yielding the final items (made of rows)
+        """
+        self._rows = rows
+        self._items = items
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def close(self):
+        """Releases the underlying cursor immediately"""
+        self._rows.close()
+        if hasattr(self._items, "close"):  # Also drops the items already read ahead
+            self._items.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 # class DbStructure(object):    #Todo
 # 	def __init__(self, **entities):
 # 		self.entities=entities
@@ -245,7 +739,9 @@ class InsertItemEvent(AbstractItemEvent):
 
 
 class SetItemEvent(AbstractItemEvent):
-    pass
+    def __init__(self, itemId, fields=None):
+        AbstractItemEvent.__init__(self, itemId)
+        self.fields = fields  # The names of the changed attributes (None: unknown)
 
 
 class GetItemEvent(AbstractItemEvent):
@@ -256,10 +752,30 @@ class RemoveItemEvent(AbstractItemEvent):
     pass
 
 
-class AddItemsEvent(AbstractEvent):
+class AbstractItemsEvent(AbstractEvent):  # Events of bulk operations
     def __init__(self, itemIds):
         AbstractEvent.__init__(self)
-        self.itemIds = itemIds
+        self.itemIds = itemIds  # A list
+
+
+class AddItemsEvent(AbstractItemsEvent):
+    pass
+
+
+class InsertItemsEvent(AbstractItemsEvent):
+    pass
+
+
+class SetItemsEvent(AbstractItemsEvent):
+    pass
+
+
+class RemoveItemsEvent(AbstractItemsEvent):
+    pass
+
+
+class UpsertItemsEvent(AbstractItemsEvent):  # Some of the items may be new, the others were overwritten
+    pass
 
 
 class GetItemsEvent(AbstractEvent):
@@ -277,6 +793,14 @@ class UpdateEvent(AbstractEvent):
     pass
 
 
+class CommitEvent(AbstractEvent):  # The posting thread committed its changes (posted on every container)
+    pass
+
+
+class RollbackEvent(AbstractEvent):  # The posting thread discarded its uncommitted changes
+    pass
+
+
 class ClearEvent(AbstractEvent):
     pass
 
@@ -285,6 +809,8 @@ class ClearEvent(AbstractEvent):
 
 
 class _AbstractEventFilter(object):
+    eventTypes = None  # The event types to filter; None means all of them
+
     def filterEvent(self, event):
         raise NotImplementedError()
 
@@ -307,6 +833,244 @@ class AbstractContainerEventFilter(_AbstractEventFilter):
         _AbstractEventFilter.filterEvent(self, event)
 
 
+class CoalescingEventFilter(AbstractContainerEventFilter):
+    """Delivers bursts of single item events to another filter as one bulk event
+
+    Consecutive AddItem-, InsertItem-, SetItem- and RemoveItemEvents of the same
+    kind are collected; any other modifying event flushes them first, so the
+    order is kept. Read events are passed on directly. The first event of a burst
+    calls schedule(flush), e.g. lambda flush: QTimer.singleShot(0, flush) to
+    deliver one batch per event-loop turn; without schedule, call flush() yourself.
+    """
+
+    batchTypes = {
+        AddItemEvent: AddItemsEvent,
+        InsertItemEvent: InsertItemsEvent,
+        SetItemEvent: SetItemsEvent,
+        RemoveItemEvent: RemoveItemsEvent,
+    }
+    passTypes = (GetItemEvent, GetItemsEvent, FilterItemsEvent)
+
+    def __init__(self, container, target, schedule=None):
+        AbstractContainerEventFilter.__init__(self, container)
+        self.target = target
+        self.schedule = schedule
+        self._batchType = None
+        self._itemIds = []
+        self._scheduled = False
+        if target.eventTypes is not None:  # Only collect the events the target wants batches of
+            self.eventTypes = tuple(
+                set(target.eventTypes).union(
+                    single for single, batch in self.batchTypes.items() if batch in target.eventTypes
+                )
+            )
+
+    def filterEvent(self, event):
+        batchType = self.batchTypes.get(type(event))
+        if batchType is None:
+            if not isinstance(event, self.passTypes):
+                self.flush()
+            self.target.filterEvent(event)
+            return
+        if batchType is not self._batchType:
+            self.flush()
+            self._batchType = batchType
+        self._itemIds.append(event.itemId)
+        if self.schedule is not None and not self._scheduled:
+            self._scheduled = True
+            self.schedule(self.flush)
+
+    def flush(self):
+        self._scheduled = False
+        if not self._itemIds:
+            return
+        event = self._batchType(self._itemIds)
+        self._batchType, self._itemIds = None, []
+        self.target.filterEvent(event)
+
+
+class ItemCache(AbstractContainerEventFilter):
+    """A bounded identity map for the items of a container
+
+    Callers share the cached item objects; the least recently used items are
+    evicted when maxSize is exceeded (maxSize=None: unbounded). The cache keeps
+    itself up-to-date by filtering the events of its container.
+    It is shared by all threads: items changed by a transaction which isn't committed
+    yet are not cached, and are discarded again when it is committed. A thread reading
+    within a transaction which began before another thread committed may still cache
+    the version of its snapshot though (until the next change of the item).
+    """
+
+    def __init__(self, container, maxSize=1000):
+        AbstractContainerEventFilter.__init__(self, container)
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._uncommitted = {}  # {thread ident: set of the ids the thread changed since its last commit}
+        self._version = 0  # Increased whenever items are discarded (see put)
+
+    @property
+    def version(self):
+        """Take it before reading an item from the engine, and pass it to put()"""
+        return self._version
+
+    def get(self, itemId):
+        """Returns the cached item or None"""
+        with self._lock:
+            item = self._items.get(itemId)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(itemId)
+            self.hits += 1
+            return item
+
+    def put(self, item, version=None):
+        """Caches an item, unless items were discarded since version or it has uncommitted changes"""
+        with self._lock:
+            if version is not None and version != self._version:  # It may have been read before a change
+                return
+            if any(item.id in itemIds for itemIds in self._uncommitted.values()):
+                return
+            self._items[item.id] = item
+            self._items.move_to_end(item.id)
+            if self.maxSize is not None and len(self._items) > self.maxSize:
+                self._items.popitem(last=False)
+
+    def discard(self, itemId):
+        self.discardAll((itemId,))
+
+    def discardAll(self, itemIds):
+        with self._lock:
+            for itemId in itemIds:
+                self._items.pop(itemId, None)
+            self._version += 1
+
+    def _changed(self, itemIds):
+        """Discards items changed by the calling thread, and keeps them uncached until it commits"""
+        with self._lock:
+            self._uncommitted.setdefault(threading.get_ident(), set()).update(itemIds)
+        self.discardAll(itemIds)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._version += 1
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "maxSize": self.maxSize, "hits": self.hits, "misses": self.misses}
+
+    eventTypes = (
+        SetItemEvent,
+        RemoveItemEvent,
+        SetItemsEvent,
+        RemoveItemsEvent,
+        UpsertItemsEvent,
+        CommitEvent,
+        RollbackEvent,
+        ClearEvent,
+        UpdateEvent,
+    )
+
+    def filterEvent(self, event):
+        if isinstance(event, (SetItemEvent, RemoveItemEvent)):
+            self._changed((event.itemId,))
+        elif isinstance(event, (SetItemsEvent, RemoveItemsEvent, UpsertItemsEvent)):
+            self._changed(event.itemIds)
+        elif isinstance(event, (CommitEvent, RollbackEvent)):
+            with self._lock:
+                itemIds = self._uncommitted.pop(threading.get_ident(), ())
+            if itemIds:  # Others may have cached them meanwhile, reading the version before the commit
+                self.discardAll(itemIds)
+        else:
+            self.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _eventTypes(baseType=AbstractEvent):
+    """Returns all (currently defined) event types"""
+    types = [baseType]
+    for subType in baseType.__subclasses__():
+        types.extend(_eventTypes(subType))
+    return types
+
+
+class EventDispatcher(object):
+    """Delivers events to the callbacks subscribed to their (exact) type
+
+    Dispatching is a single dict lookup; notify() doesn't even construct
+    the event if nobody subscribed to its type.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}  # {eventType: (callback, ...)}
+        self._eventFilters = []
+
+    def subscribe(self, eventType, callback):
+        """Calls callback(event) for every posted event of exactly eventType"""
+        self._subscriptions[eventType] = self._subscriptions.get(eventType, ()) + (callback,)
+
+    def unsubscribe(self, eventType, callback):
+        callbacks = list(self._subscriptions[eventType])
+        callbacks.remove(callback)
+        if callbacks:
+            self._subscriptions[eventType] = tuple(callbacks)
+        else:
+            del self._subscriptions[eventType]
+
+    def hasSubscribers(self, eventType):
+        return eventType in self._subscriptions
+
+    def notify(self, eventType, *args):
+        """Constructs an event of eventType (with args) and posts it - only if anybody subscribed"""
+        callbacks = self._subscriptions.get(eventType)
+        if callbacks:
+            event = eventType(*args)
+            for callback in callbacks:
+                callback(event)
+
+    def postEvent(self, event):
+        """Posts an event
+
+        The callbacks subscribed to its type are called
+        :param event: an AbstractEvent
+        """
+        for callback in self._subscriptions.get(type(event), ()):
+            callback(event)
+
+    # Event filters (subscribe their filterEvent method)
+
+    def addEventFilter(self, eventFilter):
+        """Adds an event filter
+
+        Its filterEvent method is subscribed to the types in eventFilter.eventTypes
+        (to all event types defined so far, if it has none)
+        :param eventFilter: an object with a 'filterEvent' method
+        """
+        for eventType in self._filterTypes(eventFilter):
+            self.subscribe(eventType, eventFilter.filterEvent)
+        self._eventFilters.append(eventFilter)
+
+    def removeEventFilter(self, eventFilter):
+        """Removes an event filter
+
+        :param eventFilter: an object with a 'filterEvent' method
+        """
+        self._eventFilters.remove(eventFilter)
+        for eventType in self._filterTypes(eventFilter):
+            self.unsubscribe(eventType, eventFilter.filterEvent)
+
+    @staticmethod
+    def _filterTypes(eventFilter):
+        eventTypes = getattr(eventFilter, "eventTypes", None)
+        return _eventTypes() if eventTypes is None else eventTypes
+
+
 # Engines
 
 
@@ -330,6 +1094,27 @@ class AbstractDatabaseEngine(object, metaclass=ABCMeta):
     def commit(self):
         pass
 
+    # Transactions (engines without them just keep all changes)
+
+    def begin(self):
+        """Starts a transaction"""
+        pass
+
+    def rollback(self):
+        """Discards everything since the last commit"""
+        pass
+
+    def savepoint(self, name):
+        pass
+
+    def releaseSavepoint(self, name):
+        """Keeps the changes since the savepoint (as part of the enclosing transaction)"""
+        pass
+
+    def rollbackToSavepoint(self, name):
+        """Discards the changes since the savepoint and releases it"""
+        pass
+
     def addContainer(self, container):
         pass
 
@@ -339,6 +1124,10 @@ class AbstractDatabaseEngine(object, metaclass=ABCMeta):
 
 
 class AbstractContainerEngine(object, metaclass=ABCMeta):
+    streamBatchSize = 1000  # Rows fetched at once by the streaming reads (see streamItems)
+    supportsRankCounts = False  # Whether rankCounts() is implemented (in a single query)
+    supportsMaterializedRankCounts = False  # Whether materializeRankCounts() is implemented
+
     def __init__(self, container):
         self.container = container
 
@@ -368,35 +1157,192 @@ class AbstractContainerEngine(object, metaclass=ABCMeta):
     def removeItems(self, itemIds):
         pass
 
+    def page(self, afterId, limit, orderBy="id"):
+        """Returns up to limit items following the keyset cursor afterId, ordered by (orderBy, id)
+
+        None values come first. Reimplement, this default implementation scans all items
+        :param afterId: None, the id of the last item before (orderBy "id") or a tuple (value, id)
+        :return: an iterable of items
+        """
+        key = pageKey(orderBy)
+        if orderBy != "id":  # (value is not None, value, id), so None is never compared with a value
+            key = lambda item, valueKey=key: _nullsFirst(valueKey(item))
+            afterId = None if afterId is None else _nullsFirst(afterId)
+        items = self.allItems()
+        if afterId is not None:
+            items = (item for item in items if key(item) > afterId)
+        return heapq.nsmallest(limit, items, key=key)
+
+    def streamItems(self, where=None, batchSize=None):
+        """Yields the items (matching the Expression where), holding at most batchSize rows at a time
+
+        Closing the returned generator releases the cursor at once.
+        Reimplement, this default implementation doesn't bound the memory used by the engine
+        """
+        yield from self.allItems() if where is None else self.filterItems(where)
+
+    def upsertItems(self, items):
+        """Inserts the items or completely overwrites the existing ones (reimplement with a native upsert)"""
+        for item in items:
+            if self.checkItemExists(item.id):
+                item.markDirty()
+                self.setItem(item)
+            else:
+                self.insertItem(item)
+
     @abstractmethod
     def filterItems(self, check):
-        return filter(None, [])
+        """:param check: an Expression or a callable (see makePredicate)"""
+        return filter(makePredicate(check), [])
 
     @abstractmethod
     def itemIds(self):
         raise NotImplementedError()
 
+    def aggregate(self, groupBy, count, sums, where=None):
+        """Counts and sums items per group in a single pass (reimplement to push it down to the storage)
+
+        :param groupBy: a tuple of attribute names
+        :param count: whether to count the items of each group
+        :param sums: a tuple of attribute names to sum up (None values are skipped)
+        :param where: None or a filter for filterItems
+        :return: a list of result dicts (see aggregateRow)
+        """
+        items = self.allItems() if where is None else self.filterItems(where)
+        groups = {}
+        for item in items:
+            key = tuple(getattr(item, name) for name in groupBy)
+            totals = groups.get(key)
+            if totals is None:
+                totals = groups[key] = [0] + [None] * len(sums)
+            totals[0] += 1
+            for i, name in enumerate(sums, 1):
+                value = getattr(item, name)
+                if value is not None:
+                    totals[i] = value if totals[i] is None else totals[i] + value
+        if not groupBy and not groups:  # Like sql, an aggregate without groups always has one row
+            groups[()] = [0] + [None] * len(sums)
+        return [aggregateRow(groupBy, key, count, sums, totals) for key, totals in groups.items()]
+
+    def rankCounts(self, ranks, flag):
+        """Counts how often each value occurs at each rank, over the items whose flag is set
+
+        e.g. ballots with the ranks ("vote1", ..., "vote6") and the flag "valid".
+        Only for engines which can push this down into a single query (see supportsRankCounts)
+        :param ranks: a tuple of attribute names, the first one is rank 1
+        :param flag: the name of a BoolAttribute
+        :return: see rankCountsFromRows
+        """
+        raise NotImplementedError("{} can't count ranks".format(type(self).__name__))
+
+    def materializeRankCounts(self, ranks, flag):
+        """Keeps the rankCounts of ranks and flag stored, updated along with every change of the items
+
+        Only for engines which can maintain them in the storage (see supportsMaterializedRankCounts)
+        :return: True if they were stored newly
+        """
+        raise NotImplementedError("{} can't materialize rank counts".format(type(self).__name__))
+
+    def readRankCounts(self):
+        """Returns the stored rank counts (see materializeRankCounts and rankCountsFromRows)
+
+        :return: None if they aren't materialized (by this engine object)
+        """
+        return None
+
+    def rebuildRankCounts(self):
+        """Counts the ranks from scratch and replaces the stored rank counts
+
+        :return: the differences found, {(rank, value): (storedCount, actualCount)}; rank 0 counts the flags.
+            None if they aren't materialized
+        """
+        return None
+
+    def select(self, names, where=None):
+        """Returns the values of some attributes of all items (reimplement to skip constructing items)
+
+        :param names: a tuple of attribute names
+        :param where: None or a filter for filterItems
+        :return: an iterable of tuples
+        """
+        items = self.allItems() if where is None else self.filterItems(where)
+        getter = operator.attrgetter(*names)
+        if len(names) == 1:
+            return ((getter(item),) for item in items)
+        return map(getter, items)
+
+    @staticmethod
+    def changedFields(item):
+        """Returns the names of the attributes a setItem has to write (the id is never among them)
+
+        :param item: an item, which was maybe loaded from this engine
+        :return: a tuple of attribute names, empty if nothing has changed
+        """
+        fields = item.dirtyFields()
+        if "id" in fields:  # Loaded from another position: everything has to be written
+            fields = tuple(item.__class__.attributes.keys())
+        return tuple(name for name in fields if name != "id")
+
+    def findBy(self, name, value):
+        """Returns all items whose attribute name equals value (reimplement to use an index)"""
+        attr = self.container.entityCls.attributes[name]
+        return self.filterItems(Comparison(attr, "==", value))
+
+    def fetchItems(self, itemIds):
+        """Fetches many items at once (reimplement with a single query if possible)
+
+        :param itemIds: a collection of distinct ids
+        :return: a dict {itemId: item}, missing ids are left out
+        """
+        items = {}
+        for itemId in itemIds:
+            try:
+                items[itemId] = self.getItem(itemId)
+            except ItemError:
+                pass
+        return items
+
     def addItem(self, item):
         return next(self.addItems([item]))
 
     def insertItem(self, item):
-        self.insertItems(item)
+        self.insertItems([item])
 
     def setItem(self, item):
-        self.setItems(item)
+        self.setItems([item])
 
     def removeItem(self, itemId):
-        self.removeItems(itemId)
+        self.removeItems([itemId])
 
     def allItems(self):
         return self.getItems(self.itemIds())
 
     def itemCount(self):
-        return len(list(self.itemIds()))
+        return sum(1 for _ in self.itemIds())
 
     def checkItemExists(self, itemId):
         return itemId in self.itemIds()
 
+    def existingIds(self, itemIds):
+        """Returns the set of those ids which exist (reimplement with a single query)"""
+        return {itemId for itemId in itemIds if self.checkItemExists(itemId)}
+
+    def _assertAllExist(self, itemIds):
+        """Raises one ItemError listing all ids which don't exist"""
+        itemIds = list(dict.fromkeys(itemIds))
+        existing = self.existingIds(itemIds)
+        missing = [itemId for itemId in itemIds if itemId not in existing]
+        if missing:
+            raise ItemError.forIds(missing, ItemError.notExistingTxt)
+
+    def _assertNoneExist(self, itemIds):
+        """Raises one ItemError listing all ids which exist already (or occur more than once)"""
+        counts = collections.Counter(itemIds)
+        existing = self.existingIds(counts)
+        offending = [itemId for itemId, count in counts.items() if count > 1 or itemId in existing]
+        if offending:
+            raise ItemError.forIds(offending, ItemError.alreadyExistingTxt)
+
     def clear(self):
         self.removeItems(self.itemIds())
 
@@ -408,19 +1354,67 @@ class AbstractContainerEngine(object, metaclass=ABCMeta):
         return self.container.database.engine
 
 
+Page = collections.namedtuple("Page", ("items", "cursor"))  # cursor is None for the last page
+
+
+def pageKey(orderBy):
+    """Returns the keyset key of an (engine) item for ItemContainer.page: its id, or (orderBy value, id)"""
+    if orderBy == "id":
+        return operator.attrgetter("id")
+    return operator.attrgetter(orderBy, "id")
+
+
+def _nullsFirst(key):
+    value, itemId = key
+    return value is not None, value, itemId
+
+
+def aggregateRow(groupBy, groupValues, count, sums, totals):
+    """Builds a result row of aggregate()
+
+    :param totals: the count followed by the sums
+    :return: a dict {groupName: value, ..., "count": count, "sum_<name>": sum, ...}
+    """
+    row = dict(zip(groupBy, groupValues))
+    if count:
+        row["count"] = totals[0]
+    for name, total in zip(sums, totals[1:]):
+        row["sum_" + name] = total
+    return row
+
+
+def rankCountsFromRows(rows):
+    """Builds the result of rankCounts() from the rows of its query
+
+    :param rows: (rank, value, count) rows; those with rank 0 count the items per flag value
+    :return: a tuple ({(rank, value): count}, flaggedCount, unflaggedCount); None values aren't counted per rank
+    """
+    counts, flagged, unflagged = {}, 0, 0
+    for rank, value, count in rows:
+        if rank:
+            counts[(rank, value)] = count
+        elif value:
+            flagged += count
+        else:
+            unflagged += count
+    return counts, flagged, unflagged
+
+
 # Database object
 
 
-class Database(object):
+class Database(EventDispatcher):
     """
     Abstraction of a Database
     """
 
     def __init__(self, engine=None):
+        EventDispatcher.__init__(self)
         self.containers = {}
         self._engine = None
-        self._eventFilters = []
         self._open = False
+        self._transactions = threading.local()  # Engines have connections per thread, so do transactions
+        self._groupCommit = (None, None)
         if engine:
             self.setEngine(engine)
 
@@ -428,27 +1422,107 @@ class Database(object):
         """Opens the database, and returns if it was created newly"""
         new = self.engine.open(*args, **kwargs)
         self._open = True
-        self.postEvent(OpenDbEvent())
+        self.notify(OpenDbEvent)
         return new
 
     def close(self, *args, **kwargs):
         """Closes the database"""
+        self.commit()
         self.engine.close(*args, **kwargs)
         self._open = False
-        self.postEvent(CloseDbEvent())
+        self.notify(CloseDbEvent)
 
     @contextlib.contextmanager
     def do(self):
-        """A context manager which updates all containers before,
-        and commits everything afterwards"""
+        """A context manager making its block a transaction
 
-        # try: yield
-        # except: self.rollback()
-        # else: self.commit()
+        Everything done within the block is committed afterwards, or rolled back
+        if an exception is raised. Nested blocks are savepoints of the enclosing
+        transaction. With group commit (see setGroupCommit) finished blocks are
+        committed together, a failing block still only rolls back itself.
+        """
+        state = self._transactionState()
+        savepoint = None
+        if state.depth or state.pending:
+            savepoint = "qvc_savepoint{}".format(state.depth)
+            self.engine.savepoint(savepoint)
+        else:
+            self.engine.begin()
+        written = len(state.written)
+        state.depth += 1
+        try:
+            yield
+        except BaseException:
+            state.depth -= 1
+            if savepoint is None:
+                self.rollback()
+            else:
+                self.engine.rollbackToSavepoint(savepoint)
+                self._forgetWritten(written)
+                self.updateAll()
+            raise
+        state.depth -= 1
+        if savepoint is not None:
+            self.engine.releaseSavepoint(savepoint)
+        if state.depth == 0:
+            state.pending += 1
+            if state.pendingSince is None:
+                state.pendingSince = time.monotonic()
+            self.flushIfDue()
+
+    def setGroupCommit(self, maxOperations=None, maxDelay=None):
+        """Commits finished transactions (i.e. do()-blocks) in groups
+
+        A group is committed as soon as it has maxOperations transactions or its
+        first one is older than maxDelay milliseconds; call flushIfDue() regularly
+        (e.g. from a timer) so the latter also happens without further transactions.
+        Without any limit (the default), every transaction is committed at once.
+        Mind the trade-off: a finished block is only durable once its group is committed,
+        so a crash loses up to maxOperations blocks or maxDelay milliseconds of them.
+        """
+        self._groupCommit = (maxOperations, maxDelay)
 
-        # self.updateAll()
-        yield
-        self.commit()
+    def flushIfDue(self):
+        """Commits the pending transactions of this thread if the group commit limits are reached
+
+        :return: whether it committed
+        """
+        state = self._transactionState()
+        if state.depth or not state.pending:
+            return False
+        maxOperations, maxDelay = self._groupCommit
+        if (
+            (maxOperations is None and maxDelay is None)
+            or (maxOperations is not None and state.pending >= maxOperations)
+            or (maxDelay is not None and (time.monotonic() - state.pendingSince) * 1000 >= maxDelay)
+        ):
+            self.commit()
+            return True
+        return False
+
+    def _transactionState(self):
+        state = self._transactions
+        if not hasattr(state, "depth"):
+            state.depth, state.pending, state.pendingSince = 0, 0, None
+            state.written = []  # Items marked clean since the last commit
+        return state
+
+    def noteWritten(self, items):
+        """Remembers items which were marked clean within a transaction (called by the containers)
+
+        If the transaction (or the savepoint they were written in) is rolled back,
+        they are marked dirty again, so setting them again writes them completely
+        """
+        state = self._transactionState()
+        if state.depth or state.pending:
+            state.written.extend(items)
+
+    def _forgetWritten(self, start=0):
+        """Marks the items written since state.written[start] dirty, their snapshots were rolled back"""
+        state = self._transactionState()
+        for item in state.written[start:]:
+            item.markDirty()
+        del state.written[start:]
 
     @property
     def isOpen(self):
@@ -468,6 +1542,21 @@ class Database(object):
     def commit(self):
         """Makes sure, all changes are committed"""
         self.engine.commit()
+        state = self._transactionState()
+        state.pending, state.pendingSince = 0, None
+        del state.written[:]
+        for container in self.containers.values():
+            container.notify(CommitEvent)
+
+    def rollback(self):
+        """Discards all uncommitted changes (including pending group commits)"""
+        self.engine.rollback()
+        state = self._transactionState()
+        state.pending, state.pendingSince = 0, None
+        self._forgetWritten()
+        for container in self.containers.values():
+            container.notify(RollbackEvent)
+        self.updateAll()  # Caches and views must forget the discarded changes
 
     def checkAccess(self):
         """Checks, if the database is accessible (i.e. isOpen)"""
@@ -499,21 +1588,11 @@ class Database(object):
     def addContainer(self, container):
         containerId = self.containers[container.entityCls.__realName__] = container
         self.engine.addContainer(container)
-        self.postEvent(AddContainerEvent(containerId))
+        self.notify(AddContainerEvent, containerId)
 
     def currentDateTime(self):  # Reimplement (if u want)
         return datetime.datetime.now()
 
-    def addEventFilter(self, eventFilter):
-        self._eventFilters.append(eventFilter)
-
-    def removeEventFilter(self, eventFilter):
-        self._eventFilters.remove(eventFilter)
-
-    def postEvent(self, event):
-        for eventFilter in self._eventFilters:
-            eventFilter.filterEvent(event)
-
 
 def _requiresAccess(func):
     @functools.wraps(func)
@@ -524,9 +1603,11 @@ def _requiresAccess(func):
     return wrapper
 
 
-class ItemContainer(object):
+class ItemContainer(EventDispatcher):
     """Represents a (SQL-) Table"""
 
+    refChunkSize = 500  # How many items share one batch of reference lookups
+
     def __init__(self, database, entityCls):
         """Initializes a new ItemContainer object
 
@@ -537,34 +1618,256 @@ class ItemContainer(object):
         """
         if "id" not in entityCls.attributes:
             raise RuntimeError("ItemContainer only accepts Entities WITH an id (i.e. primary key)")
+        EventDispatcher.__init__(self)
         self.database = database
         self.entityCls = entityCls
         self._engine = self.database.engine.createContainerEngine(self)
         self._engine.container = self
-        self._eventFilters = []
+        self._cache = None
+        self._count = None  # Maintained by the modifying methods, None: unknown (counted on demand)
         self._refAttrs = {
             name: attr.entityCls.__realName__
             for name, attr in self.entityCls.attributes.items()
             if isinstance(attr, ReferenceAttribute)
         }
+        self._lazyRefAttrs = {name for name in self._refAttrs if self.entityCls.attributes[name].lazy}
 
     def _getRefs(self, item):
-        dic = {}
-        for name, container in self._refAttrs.items():
-            if getattr(item, name) is not None:
-                dic[name] = self.database.containers[container].getItem(getattr(item, name))
-        return item.copy(**dic)
+        return next(self._resolveRefs((item,)))
+
+    def _resolveRefs(self, items, chunkSize=None):
+        """Replaces the referenced ids of items by the referenced items
+
+        The items are processed chunk by chunk; all ids referencing the same container
+        within a chunk are fetched with a single engine call
+        :param items: an iterable of items as returned by the engine
+        :param chunkSize: the maximum chunk size (default: refChunkSize)
+        :return: an iterator of items
+        """
+        if not self._refAttrs:
+            return iter(items)
+        return self._resolveRefsGen(iter(items), chunkSize or self.refChunkSize)
+
+    def _resolveRefsGen(self, items, chunkSize):
+        while True:
+            chunk = list(itertools.islice(items, chunkSize))
+            if not chunk:
+                return
+            refIds = collections.defaultdict(set)
+            for item in chunk:
+                for name, container in self._refAttrs.items():
+                    refId = getattr(item, name)
+                    if refId is not None and name not in self._lazyRefAttrs:
+                        refIds[container].add(refId)
+            refItems = {
+                container: self.database.containers[container].fetchItems(ids) for container, ids in refIds.items()
+            }
+            lazyRefs = {}  # Items of a chunk share their lazy references, so each is loaded at most once
+            for item in chunk:
+                dic = {}
+                for name, container in self._refAttrs.items():
+                    refId = getattr(item, name)
+                    if refId is None:
+                        continue
+                    if name in self._lazyRefAttrs:
+                        try:
+                            dic[name] = lazyRefs[container, refId]
+                        except KeyError:
+                            ref = lazyRefs[container, refId] = EntityRef(self.database.containers[container], refId)
+                            dic[name] = ref
+                        continue
+                    try:
+                        dic[name] = refItems[container][refId]
+                    except KeyError:
+                        raise ItemError(refId, ItemError.notExistingTxt) from None
+                yield item.copy(**dic)
+
+    def fetchItems(self, itemIds):
+        """Fetches many items (with resolved references) at once
+
+        :param itemIds: a collection of distinct ids
+        :return: a dict {itemId: item}, missing ids are left out
+        """
+        if self._cache is None:
+            return {item.id: item for item in self._resolveRefs(self.engine.fetchItems(itemIds).values())}
+        items, missing, version = {}, [], self._cache.version
+        for itemId in itemIds:
+            item = self._cache.get(itemId)
+            if item is None:
+                missing.append(itemId)
+            else:
+                items[itemId] = item
+        if missing:
+            for item in self._resolveRefs(self.engine.fetchItems(missing).values()):
+                self._cache.put(item, version)
+                items[item.id] = item
+        return items
+
+    @_requiresAccess
+    def aggregate(self, groupBy=(), count=True, sum=(), where=None):
+        """Counts and sums up items per group without constructing items where possible
+
+        e.g. votes.aggregate(groupBy=Vote.vote_group, sum=Vote.valid, where=Vote.vote1 != None)
+        :param groupBy: attribute(s) or attribute name(s) to group by
+        :param count: whether to count the items of each group
+        :param sum: attribute(s) or attribute name(s) to sum up
+        :param where: None, or a filter as for filterItems (preferably an Expression)
+        :return: a list of dicts {groupName: value, ..., "count": count, "sum_<name>": sum, ...};
+            references are given as ids
+        """
+        return self.engine.aggregate(self._attrNames(groupBy), count, self._attrNames(sum), asFilter(where))
+
+    @_requiresAccess
+    def rankCounts(self, ranks, flag):
+        """Counts the values of rank attributes in a single query, without constructing any items
+
+        e.g. counts, valid, invalid = votes.rankCounts((Vote.vote1, Vote.vote2), Vote.valid)
+        :param ranks: attributes or attribute names, the first one is rank 1
+        :param flag: an attribute (name); only items where it is set are counted per rank
+        :return: a tuple ({(rank, value): count}, flaggedCount, unflaggedCount); references are given as ids
+        :raises NotImplementedError: if the engine can't do this in the storage (see supportsRankCounts)
+        """
+        return self.engine.rankCounts(self._attrNames(ranks), self._attrNames(flag)[0])
+
+    @_requiresAccess
+    def materializeRankCounts(self, ranks, flag):
+        """Stores the rank counts in the database, where they are kept up to date with every change
+
+        Reading them with readRankCounts() then costs O(values) instead of a scan of all items.
+        :param ranks: attributes or attribute names, the first one is rank 1
+        :param flag: an attribute (name), as for rankCounts
+        :return: True if they were stored newly
+        :raises NotImplementedError: if the engine can't maintain them (see supportsMaterializedRankCounts)
+        """
+        return self.engine.materializeRankCounts(self._attrNames(ranks), self._attrNames(flag)[0])
+
+    @_requiresAccess
+    def readRankCounts(self):
+        """Returns the materialized rank counts, like rankCounts(), or None if they aren't materialized"""
+        return self.engine.readRankCounts()
+
+    @_requiresAccess
+    def rebuildRankCounts(self):
+        """Recounts the materialized rank counts from scratch, a consistency check
+
+        :return: the differences found, {(rank, value): (storedCount, actualCount)} (empty if consistent);
+            None if they aren't materialized
+        """
+        return self.engine.rebuildRankCounts()
+
+    @property
+    def supportsRankCounts(self):
+        """Returns whether rankCounts() can be used with this engine"""
+        return self.engine.supportsRankCounts
+
+    @property
+    def supportsMaterializedRankCounts(self):
+        """Returns whether materializeRankCounts() can be used with this engine"""
+        return self.engine.supportsMaterializedRankCounts
+
+    @_requiresAccess
+    def select(self, *attrs, where=None):
+        """Streams the values of the given attributes, without constructing any items
+
+        e.g. for vote1, valid in votes.select(Vote.vote1, "valid"): ...
+        References are neither resolved nor checked, they are given as ids.
+        :param attrs: attributes or attribute names
+        :param where: None, or a filter as for filterItems (preferably an Expression)
+        :return: an iterable of tuples
+        """
+        return self.engine.select(self._attrNames(attrs), asFilter(where))
+
+    @_requiresAccess
+    def page(self, afterId=None, limit=100, orderBy=None):
+        """Returns one page of items in keyset order
+
+        e.g. page = votes.page(limit=50); nextPage = votes.page(page.cursor, 50)
+        Unlike offsets, the cursor stays valid while items are added or removed.
+        :param afterId: the cursor of the previous page (None for the first page)
+        :param limit: the maximum number of items of the page
+        :param orderBy: an attribute (name) to order by (default: the id); equal values are ordered by id,
+            None values come first
+        :return: a Page(items, cursor), the cursor is None if there are no further items
+        """
+        orderBy = "id" if orderBy is None else self._attrNames(orderBy)[0]
+        rows = list(self.engine.page(afterId, limit + 1, orderBy))  # One more, to know whether there are more
+        cursor = pageKey(orderBy)(rows[limit - 1]) if len(rows) > limit else None
+        return Page(list(self._resolveRefs(rows[:limit])), cursor)
+
+    @_requiresAccess
+    def findBy(self, attr, value):
+        """Returns all items whose attribute equals value
+
+        Declare the attribute with index=True (or unique=True) so the engine can use an index
+        :param attr: an attribute or attribute name
+        :return: an iterable of items
+        """
+        (name,) = self._attrNames(attr)
+        return self._resolveRefs(self.engine.findBy(name, value))
+
+    def findOneBy(self, attr, value):
+        """Returns the first item whose attribute equals value (see findBy)
+
+        :raise ItemError: if there is no such item
+        """
+        for item in self.findBy(attr, value):
+            return item
+        raise ItemError(None, "No item with {}={!r}".format(self._attrNames(attr)[0], value))
+
+    def _attrNames(self, attrs):
+        """Converts an attribute (name) or a sequence of them to a tuple of validated names"""
+        if isinstance(attrs, (str, Attribute)):
+            attrs = (attrs,)
+        names = tuple(attr.name if isinstance(attr, Attribute) else attr for attr in attrs)
+        for name in names:
+            if name not in self.entityCls.attributes:
+                raise AttributeError("{} has no attribute {}".format(self.entityCls.__name__, name))
+        return names
+
+    def enableCache(self, maxSize=1000):
+        """Keeps (up to maxSize) fetched items in an identity map
+
+        getItem and reference resolution are served from it; the items are
+        shared between all callers, so modify them only to set them afterwards
+        :param maxSize: the maximum number of cached items (None: unbounded)
+        :return: the ItemCache
+        """
+        self.disableCache()
+        self._cache = ItemCache(self, maxSize)
+        self.addEventFilter(self._cache)
+        return self._cache
+
+    def disableCache(self):
+        if self._cache is not None:
+            self.removeEventFilter(self._cache)
+            self._cache = None
+
+    @property
+    def cache(self):
+        """Returns the ItemCache (or None if caching is disabled)"""
+        return self._cache
 
     def _setRefs(self, item):
+        """Returns a copy of item with its references replaced by ids, applying the write policies"""
         dic = {}
         for name, container in self._refAttrs.items():
             val = getattr(item, name)
             if val is None:
                 continue
+            if isinstance(val, EntityRef):
+                if not val.isLoaded():  # Nothing can have changed
+                    dic[name] = val.id
+                    continue
+                val = val.item
+            policy = self.entityCls.attributes[name].writePolicy
             if val.id == Entity.id.default:  # The id was not specifically assigned
                 dic[name] = self.database.containers[container].addItem(val)
+            elif policy == ReferenceAttribute.STORE_ID_ONLY:
+                dic[name] = val.id
             else:
-                dic[name] = self.database.containers[container].setItem(val)
+                if policy == ReferenceAttribute.CASCADE_ALWAYS:
+                    val.markDirty()
+                dic[name] = self.database.containers[container].setItem(val)  # Skipped if nothing has changed
         return item.copy(**dic)
 
     @_requiresAccess
@@ -576,15 +1879,23 @@ class ItemContainer(object):
         :return: the assigned id (integer)
         """
         item.id = self.engine.addItem(self._setRefs(item))
-        self.postEvent(AddItemEvent(item.id))
+        item.markClean()
+        self.database.noteWritten((item,))
+        self._countChanged(1)
+        self.notify(AddItemEvent, item.id)
         return item.id
 
     @_requiresAccess
-    def addItems(self, *items):  # For fake data
+    def addItems(self, *items):
+        """Adds many items at once (posting a single AddItemsEvent)
+
+        :return: a list of the assigned ids
+        """
         if hasattr(items[0], "__iter__") and len(items) == 1:
             items = items[0]
-        itemIds = self.engine.addItems(map(self._setRefs, items))
-        # self.postEvent(AddItemsEvent(itemIds))    #would empty itemIds generator  #Todo
+        itemIds = list(self.engine.addItems(map(self._setRefs, items)))
+        self._countChanged(len(itemIds))
+        self.notify(AddItemsEvent, itemIds)
         return itemIds
 
     @_requiresAccess
@@ -595,15 +1906,24 @@ class ItemContainer(object):
         :param item: an instance of the EntityCls
         """
         self.engine.insertItem(self._setRefs(item))
-        self.postEvent(InsertItemEvent(item.id))
+        item.markClean()
+        self.database.noteWritten((item,))
+        self._countChanged(1)
+        self.notify(InsertItemEvent, item.id)
         return item.id
 
     @_requiresAccess
     def insertItems(self, *items):
+        """Inserts many items at once (posting a single InsertItemsEvent)"""
         if hasattr(items[0], "__iter__") and len(items) == 1:
             items = items[0]
-        self.engine.insertItems(map(self._setRefs, items))
-        # self.postEvent(InsertItemEvent())
+        items = list(items)
+        self.engine.insertItems([self._setRefs(item) for item in items])
+        for item in items:
+            item.markClean()
+        self.database.noteWritten(items)
+        self._countChanged(len(items))
+        self.notify(InsertItemsEvent, [item.id for item in items])
 
     @_requiresAccess
     def getItem(self, itemId):
@@ -612,28 +1932,73 @@ class ItemContainer(object):
         :param itemId: the id of the item
         :return: an instance of the EntityCls
         """
-        item = self._getRefs(self.engine.getItem(itemId))
-        self.postEvent(GetItemEvent(itemId))
+        if self._cache is None:
+            item = self._getRefs(self.engine.getItem(itemId))
+        else:
+            version = self._cache.version
+            item = self._cache.get(itemId)
+            if item is None:
+                item = self._getRefs(self.engine.getItem(itemId))
+                self._cache.put(item, version)
+        self.notify(GetItemEvent, itemId)
         return item
 
     @_requiresAccess
     def getItems(self, *itemIds):
         if hasattr(itemIds[0], "__iter__") and len(itemIds) == 1:
             itemIds = itemIds[0]
-        items = map(self._getRefs, self.engine.getItems(itemIds))
-        self.postEvent(GetItemsEvent())
+        items = self._resolveRefs(self.engine.getItems(itemIds))
+        self.notify(GetItemsEvent)
         return items
 
     @_requiresAccess
     def setItem(self, item):
         """Overwrites ('updates') an existing item at position item.id
 
+        Only the attributes changed since the item was loaded are written;
+        if nothing has changed, neither the engine is called nor an event is posted
         :param item: an instance of the EntityCls
         """
-        self.engine.setItem(self._setRefs(item))
-        self.postEvent(SetItemEvent(item.id))
+        stored = self._setRefs(item)
+        fields = self.engine.changedFields(stored)
+        if fields:
+            self.engine.setItem(stored)
+            self.notify(SetItemEvent, item.id, fields)
+        item.markClean()
+        self.database.noteWritten((item,))
         return item.id
 
+    @_requiresAccess
+    def setItems(self, *items):
+        """Overwrites many existing items at once (posting a single SetItemsEvent for the changed ones)"""
+        if hasattr(items[0], "__iter__") and len(items) == 1:
+            items = items[0]
+        items = list(items)
+        changed = [stored for stored in map(self._setRefs, items) if self.engine.changedFields(stored)]
+        if changed:
+            self.engine.setItems(changed)
+            self.notify(SetItemsEvent, [item.id for item in changed])
+        for item in items:
+            item.markClean()
+        self.database.noteWritten(items)
+
+    @_requiresAccess
+    def upsertItems(self, *items):
+        """Inserts items at position item.id or overwrites the existing ones there (posting an UpsertItemsEvent)
+
+        The engines do this natively (e.g. INSERT ... ON CONFLICT(id) DO UPDATE), i.e. without checking
+        every id first; the items are always written completely.
+        """
+        if hasattr(items[0], "__iter__") and len(items) == 1:
+            items = items[0]
+        items = list(items)
+        self.engine.upsertItems([self._setRefs(item) for item in items])
+        for item in items:
+            item.markClean()
+        self.database.noteWritten(items)
+        self._count = None  # Not known how many of them were new
+        self.notify(UpsertItemsEvent, [item.id for item in items])
+
     @_requiresAccess
     def removeItem(self, itemId):
         """Removes an item from the database
@@ -641,24 +2006,59 @@ class ItemContainer(object):
         :param itemId: the id of the item which should be removed
         """
         self.engine.removeItem(itemId)
-        self.postEvent(RemoveItemEvent(itemId))
+        self._countChanged(-1)
+        self.notify(RemoveItemEvent, itemId)
+
+    @_requiresAccess
+    def removeItems(self, *itemIds):
+        """Removes many items at once (posting a single RemoveItemsEvent)"""
+        if hasattr(itemIds[0], "__iter__") and len(itemIds) == 1:
+            itemIds = itemIds[0]
+        itemIds = list(itemIds)
+        self.engine.removeItems(itemIds)
+        self._countChanged(-len(itemIds))
+        self.notify(RemoveItemsEvent, itemIds)
 
     @_requiresAccess
     def filterItems(self, check):
         """Filters items by condition
 
-        :param check: a callable returning True or False; given an item
+        :param check: an Expression (e.g. (Vote.vote_group == grp) & Vote.valid) or a bare boolean attribute,
+            which the engine may evaluate natively; or a callable returning True or False given an item
+            (it is given the items as stored by the engine, i.e. with references as ids)
         :return: an iterable of all items where check returned True
         """
-        items = map(self._getRefs, self.engine.filterItems(check))
+        items = self._resolveRefs(self.engine.filterItems(asFilter(check)))
         # self.postEvent(FilterItemsEvent(check, [item.id for item in items]))    #Todo: Here's the problem
         return items
 
+    @_requiresAccess
+    def iterItems(self, where=None, batchSize=None):
+        """Streams the items (matching where) in constant memory
+
+        The engine fetches batchSize rows at a time (default: engine.streamBatchSize); at most that many
+        items (plus their references) are held at once. Stopping early, call close() on the returned
+        iterator (or use it in a with statement) to release the underlying cursor immediately.
+        :param where: None, an Expression, a bare boolean attribute or a callable (see filterItems)
+        :param batchSize: the number of rows fetched at once
+        :return: an ItemIterator
+        """
+        batchSize = batchSize or self.engine.streamBatchSize
+        where = asFilter(where)
+        if where is None or isinstance(where, Expression):
+            rows = self.engine.streamItems(where, batchSize)
+            items = rows
+        else:
+            rows = self.engine.streamItems(None, batchSize)
+            items = filter(makePredicate(where), rows)
+        return ItemIterator(rows, self._resolveRefs(items, min(batchSize, self.refChunkSize)))
+
     @_requiresAccess
     def clear(self):
         """Clears this container, i.e empties it"""
         self.engine.clear()
-        self.postEvent(ClearEvent())
+        self._count = 0
+        self.notify(ClearEvent)
 
     def update(self):
         """Makes sure all items are up-to-date
@@ -666,7 +2066,8 @@ class ItemContainer(object):
         Calling this is useless for some engines, but though recommended
         """
         self.engine.update()
-        self.postEvent(UpdateEvent())
+        self._count = None  # Resynced with the engine on demand
+        self.notify(UpdateEvent)
 
     def itemIds(self):
         """Returns all ids of all items
@@ -681,8 +2082,8 @@ class ItemContainer(object):
 
         :return: iterable
         """
-        items = map(self._getRefs, self.engine.allItems())
-        self.postEvent(GetItemsEvent())
+        items = self._resolveRefs(self.engine.allItems())
+        self.notify(GetItemsEvent)
         return items
 
     @property
@@ -693,32 +2094,16 @@ class ItemContainer(object):
         """
         return self._engine
 
-    def addEventFilter(self, eventFilter):
-        """Adds an event filter
-
-        :param eventFilter: an object with a 'filterEvent' method
-        """
-        self._eventFilters.append(eventFilter)
-
-    def removeEventFilter(self, eventFilter):
-        """Removes an event filter
-
-        :param eventFilter: an object with a 'filterEvent' method
-        """
-        self._eventFilters.remove(eventFilter)
-
-    def postEvent(self, event):
-        """Posts an event
-
-        All EventFilter.filterEvent methods are called
-        :param event: an AbstractEvent
-        """
-        for eventFilter in self._eventFilters:
-            eventFilter.filterEvent(event)
+    def _countChanged(self, delta):
+        if self._count is not None:
+            self._count += delta
 
     # @requiresAccess
     def __len__(self):
-        return self.engine.itemCount()
+        """Returns the number of items, which is only counted by the engine after an update()"""
+        if self._count is None:
+            self._count = self.engine.itemCount()
+        return self._count
 
     def __iter__(self):
         return iter(self.allItems())
@@ -1,10 +1,16 @@
+import itertools
+import operator
+
 import psycopg2
 
 from ..core import (
     AbstractDatabaseEngine,
     AbstractContainerEngine,
+    Expression,
     ItemError,
     MetaItem,
+    aggregateRow,
+    rankCountsFromRows,
     BoolAttribute,
     DateTimeAttribute,
     StringAttribute,
@@ -16,6 +22,8 @@ from ..tools import isinstancePool
 
 
 class PgSqlTable(object):
+    streamBatchSize = 1000  # Rows fetched at once by the streaming reads
+    _streamIds = itertools.count()  # For unique cursor names
     attrTypes = {
         IntAttribute: "INTEGER",
         StringAttribute: "TEXT",
@@ -29,25 +37,38 @@ class PgSqlTable(object):
         # Define sql statements to effectively increase speed
         self.tblName = tblName
         self.entityCls = entityCls
+        # psycopg2 placeholders: %s, or %(name)s for the values of a dict
+        values = ", ".join("%({})s".format(name) for name in self.entityCls.attributes.keys())
         self._insertSql = "INSERT INTO {tblName} ({fields}) VALUES ({values});".format(
-            tblName=self.tblName,
-            fields=", ".join(self.entityCls.attributes.keys()),
-            values=", ".join(":" + name for name in self.entityCls.attributes.keys()),
+            tblName=self.tblName, fields=", ".join(self.entityCls.attributes.keys()), values=values
         )
-        self._setSql = "UPDATE {tblName} SET {fields} WHERE id=:id;".format(
+        self._setSqls = {}  # {fields: sql} (see _setSqlFor)
+        self._setSql = self._setSqlFor(tuple(name for name in self.entityCls.attributes.keys() if name != "id"))
+        updates = ", ".join(
+            "{name}=EXCLUDED.{name}".format(name=name) for name in self.entityCls.attributes.keys() if name != "id"
+        )
+        self._upsertSql = "INSERT INTO {tblName} ({fields}) VALUES ({values}) ON CONFLICT (id) DO {update};".format(
             tblName=self.tblName,
-            fields=", ".join(
-                "{name}=:{name}".format(name=name) for name in self.entityCls.attributes.keys() if name != "id"
-            ),
+            fields=", ".join(self.entityCls.attributes.keys()),
+            values=values,
+            update="UPDATE SET " + updates if updates else "NOTHING",
         )
-        self._getSql = "SELECT * FROM {tblName} WHERE id=?;".format(tblName=self.tblName)
-        self._getManySql = "SELECT * FROM {tblName} WHERE id in (?);".format(tblName=tblName)
+        self._getSql = "SELECT * FROM {tblName} WHERE id=%s;".format(tblName=self.tblName)
+        self._fetchManySql = "SELECT * FROM {tblName} WHERE id IN %s;".format(tblName=self.tblName)
         self._getAllSql = "SELECT * FROM {tblName};".format(tblName=self.tblName)
-        self._getIdsSql = "SELECT id FROM {tblName};".format(tblName=self.tblName)
-        self._checkItemSql = "SELECT id FROM {tblName} WHERE id=? LIMIT 1;".format(tblName=tblName)
+        self._filterSql = "SELECT * FROM {tblName} WHERE {{condition}};".format(tblName=self.tblName)
+        self._getIdsSql = "SELECT id FROM {tblName} ORDER BY id;".format(tblName=self.tblName)
+        self._getIdsInSql = "SELECT id FROM {tblName} WHERE id = ANY(%s);".format(tblName=self.tblName)
+        self._checkItemSql = "SELECT id FROM {tblName} WHERE id=%s LIMIT 1;".format(tblName=tblName)
         self._countSql = "SELECT COUNT (*) FROM {tblName};".format(tblName=self.tblName)
-        self._removeSql = "DELETE FROM {tblName} WHERE id=?;".format(tblName=self.tblName)
+        self._removeSql = "DELETE FROM {tblName} WHERE id=%s;".format(tblName=self.tblName)
         self._clearSql = "DELETE FROM {tblName};".format(tblName=self.tblName)
+        # New ids are drawn from a sequence, so concurrent writers never get the same ones
+        self._seqName = "{tblName}_id_seq".format(tblName=self.tblName)
+        self._reserveIdsSql = "SELECT nextval('{seq}') FROM generate_series(1, %s);".format(seq=self._seqName)
+        self._advanceSeqSql = "SELECT setval('{seq}', GREATEST(%s, (SELECT last_value FROM {seq})));".format(
+            seq=self._seqName
+        )
         self._connection = None
         self.cursor = None
         if connection is not None:
@@ -71,7 +92,39 @@ class PgSqlTable(object):
                     name=name, type=PgSqlTable.fieldType(attr), default=attr.default
                 )
             )
-        return "CREATE TABLE {tblName} ({fields});".format(tblName=self.tblName, fields=", ".join(fields))
+        return (
+            "CREATE SEQUENCE IF NOT EXISTS {seq} MINVALUE 0 START 0;CREATE TABLE {tblName} ({fields});".format(
+                seq=self._seqName, tblName=self.tblName, fields=", ".join(fields)
+            )
+            + self.createIndexSchema()
+        )
+
+    def upgradeTableSchema(self):
+        """Brings a table created by an older version up to date: the id sequence and the indexes
+
+        The sequence is created if missing, and set behind the largest stored id (so reserveIds never
+        hands out an existing id)
+        """
+        return (
+            "CREATE SEQUENCE IF NOT EXISTS {seq} MINVALUE 0 START 0;"
+            "SELECT setval('{seq}', maxId) FROM (SELECT MAX(id) AS maxId FROM {tblName}) AS ids "
+            "WHERE maxId >= (SELECT last_value FROM {seq});".format(seq=self._seqName, tblName=self.tblName)
+            + self.createIndexSchema()
+        )
+
+    def createIndexSchema(self):
+        return "".join(
+            "CREATE {unique}INDEX IF NOT EXISTS {tblName}_{name}_idx ON {tblName} ({name});".format(
+                unique="UNIQUE " if attr.unique else "", tblName=self.tblName, name=name
+            )
+            for name, attr in self.entityCls.attributes.items()
+            if attr.index and name != "id"
+        ) + "".join(
+            "CREATE INDEX IF NOT EXISTS {tblName}_{name}_idx ON {tblName} ({cols});".format(
+                tblName=self.tblName, name="_".join(index), cols=", ".join(index)
+            )
+            for index in self.entityCls.__indexes__
+        )
 
     def createTable(self, exists_ok=False):
         try:
@@ -88,22 +141,32 @@ class PgSqlTable(object):
         return tp
 
     def addItem(self, item):
-        item.id = self.nextItemId()
+        item.id = self.reserveIds(1)[0]
         self.cursor.execute(self._insertSql, {name: getattr(item, name) for name in self.entityCls.attributes.keys()})
         return item.id
 
-    def _assignIdsGen(self, items):
-        itemId = self.nextItemId()
-        for item in items:
-            item.id = itemId
-            yield {name: getattr(item, name) for name in self.entityCls.attributes.keys()}
-            itemId += 1
+    def reserveIds(self, count):
+        """Draws count new ids from the id sequence with a single query
+
+        :return: a list of the ids, no other connection will ever get them
+        """
+        self.cursor.execute(self._reserveIdsSql, (count,))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def advanceSequence(self, itemIds):
+        """Moves the id sequence behind explicitly inserted ids, so reserveIds doesn't hand them out again"""
+        maxId = max(itemIds, default=None)
+        if maxId is not None:
+            self.cursor.execute(self._advanceSeqSql, (maxId,))
 
     def addItems(self, items):
-        # if len(items) > 1000:
-        # 	raise ValueError("PgSql cannot add more than 1000 items (items: {})".format(len(items))) #Todo
-        self.cursor.executemany(self._insertSql, self._assignIdsGen(items))
-        return (item.id for item in items)
+        items = list(items)
+        itemIds = self.reserveIds(len(items)) if items else []
+        for itemId, item in zip(itemIds, items):
+            item.id = itemId
+        names = self.entityCls.attributes.keys()
+        self.cursor.executemany(self._insertSql, [{name: getattr(item, name) for name in names} for item in items])
+        return itemIds
 
     def insertItem(self, item):
         try:
@@ -113,70 +176,162 @@ class PgSqlTable(object):
         except psycopg2.IntegrityError:
             raise ItemError(item.id) from None
 
-    def _checkItemsNotExistGen(self, items):
-        for item in items:
-            if self.checkItemExists(item.id):
-                raise ItemError(item.id)
-            yield {name: getattr(item, name) for name in self.entityCls.attributes.keys()}
+    def existingIds(self, itemIds):
+        """Returns the set of those ids which exist, checked with a single query"""
+        self.cursor.execute(self._getIdsInSql, (list(itemIds),))  # psycopg2 adapts the list to an ARRAY
+        return {row[0] for row in self.cursor.fetchall()}
 
     def insertItems(self, items):
-        self.cursor.executemany(self._insertSql, self._checkItemsNotExistGen(items))
+        items = list(items)
+        self._assertNoneExist(item.id for item in items)  # See AbstractContainerEngine
+        names = self.entityCls.attributes.keys()
+        try:
+            self.cursor.executemany(self._insertSql, [{name: getattr(item, name) for name in names} for item in items])
+        except psycopg2.IntegrityError as e:  # Inserted concurrently after the check, or some other unique index
+            raise ItemError(None, str(e)) from None
 
     def getItem(self, itemId):
         self.cursor.execute(self._getSql, (itemId,))
         fetchedData = self.cursor.fetchone()
         if fetchedData is None:
             raise ItemError(itemId)
-        return self.entityCls(**dict(zip(self.entityCls.attributes.keys(), fetchedData)))
+        return self._makeItem(fetchedData)
 
     def getItems(self, itemIds):
-        self.cursor.execute(self._getManySql, ",".join(itemIds))
-        row = self.cursor.fetchone()
-        while row:
-            yield self.entityCls(**dict(zip(self.entityCls.attributes.keys(), row)))
-            row = self.cursor.fetchone()
+        itemIds = list(itemIds)
+        items = self.fetchItems(dict.fromkeys(itemIds))
+        try:
+            return [items[itemId] for itemId in itemIds]
+        except KeyError as e:
+            raise ItemError(e.args[0]) from None
+
+    def fetchItems(self, itemIds):
+        itemIds = tuple(itemIds)
+        if not itemIds:
+            return {}
+        self.cursor.execute(self._fetchManySql, (itemIds,))  # psycopg2 adapts the tuple to an IN-list
+        items = {}
+        for row in self.cursor.fetchall():
+            item = self._makeItem(row)
+            items[item.id] = item
+        return items
 
     def setItem(self, item):
+        fields = AbstractContainerEngine.changedFields(item)
+        if not fields:  # Nothing changed since the item was loaded
+            return
         if not self.checkItemExists(item.id):
             raise ItemError(item.id)
-        self.cursor.execute(self._setSql, {name: getattr(item, name) for name in self.entityCls.attributes.keys()})
-
-    def _checkItemsExistGen(self, items):
-        for item in items:
-            if not self.checkItemExists(item.id):
-                raise ItemError(item.id)
-            yield {name: getattr(item, name) for name in self.entityCls.attributes.keys()}
+        self.cursor.execute(self._setSqlFor(fields), self._makeSetVals(item, fields))
 
     def setItems(self, items):
-        self.cursor.executemany(self._setSql, self._checkItemsExistGen(items))
+        # A failing statement aborts the whole (PostgreSQL) transaction, so the bulk is all-or-nothing anyways
+        changed = [(AbstractContainerEngine.changedFields(item), item) for item in items]
+        changed = [(fields, item) for fields, item in changed if fields]
+        self._assertAllExist(item.id for _, item in changed)
+        # Consecutive items changing the same columns share one executemany (and keep their order)
+        for fields, group in itertools.groupby(changed, key=lambda pair: pair[0]):
+            self.cursor.executemany(self._setSqlFor(fields), [self._makeSetVals(item, fields) for _, item in group])
+
+    def upsertItems(self, items):
+        """Inserts or completely overwrites the items at their ids with a single executemany"""
+        try:
+            self.cursor.executemany(
+                self._upsertSql,
+                [{name: getattr(item, name) for name in self.entityCls.attributes.keys()} for item in items],
+            )
+        except psycopg2.IntegrityError as e:  # Some other unique constraint
+            raise ItemError(None, str(e)) from None
+
+    def _setSqlFor(self, fields):
+        """Returns an UPDATE statement writing only the given columns"""
+        try:
+            return self._setSqls[fields]
+        except KeyError:
+            sql = self._setSqls[fields] = "UPDATE {tblName} SET {fields} WHERE id=%(id)s;".format(
+                tblName=self.tblName, fields=", ".join("{name}=%({name})s".format(name=name) for name in fields)
+            )
+            return sql
+
+    @staticmethod
+    def _makeSetVals(item, fields):
+        vals = {name: getattr(item, name) for name in fields}
+        vals["id"] = item.id
+        return vals
+
+    def _makeItem(self, row):
+        item = self.entityCls(**dict(zip(self.entityCls.attributes.keys(), row)))
+        item.markClean()
+        return item
 
     def removeItem(self, itemId):
         if not self.checkItemExists(itemId):
             raise ItemError(itemId)
-        self.cursor.execute(self._removeSql, itemId)
-
-    def _checkIdsExistGen(self, itemIds):
-        for itemId in itemIds:
-            if not self.checkItemExists(itemId):
-                raise ItemError(itemId)
-            yield itemId
+        self.cursor.execute(self._removeSql, (itemId,))
 
     def removeItems(self, itemIds):
-        self.cursor.executemany(self._removeSql, self._checkIdsExistGen(itemIds))
+        itemIds = list(itemIds)
+        self._assertAllExist(itemIds)
+        self.cursor.executemany(self._removeSql, [(itemId,) for itemId in itemIds])
 
     def filter(self, check):
-        return filter(check, self.allItems())
+        if not isinstance(check, Expression):
+            return filter(check, self.allItems())
+        return self.streamItems(check)  # A cursor of its own, so the items may be set while iterating
 
     def allItems(self):
-        self.cursor.execute(self._getAllSql)
-        row = self.cursor.fetchone()
-        while row:
-            yield self.entityCls(**dict(zip(self.entityCls.attributes.keys(), row)))
-            row = self.cursor.fetchone()
+        return self._streamRows(self._getAllSql, (), self.streamBatchSize, self._makeItem)
 
     def itemIds(self):
-        self.cursor.execute(self._getIdsSql)
-        return (row[0] for row in self.cursor.fetchall())
+        return self._streamRows(self._getIdsSql, (), self.streamBatchSize, operator.itemgetter(0))
+
+    def page(self, afterId, limit, orderBy="id"):
+        params = []
+        sql = "SELECT * FROM {tblName}".format(tblName=self.tblName)
+        if orderBy == "id":
+            if afterId is not None:
+                sql += " WHERE id > %s"
+                params.append(afterId)
+            sql += " ORDER BY id LIMIT %s;"
+        else:
+            if afterId is not None:  # NULL values come first (a row value comparison would skip them)
+                value, itemId = afterId
+                if value is None:
+                    sql += " WHERE ({name} IS NULL AND id > %s) OR {name} IS NOT NULL".format(name=orderBy)
+                    params.append(itemId)
+                else:
+                    sql += " WHERE {name} > %s OR ({name} = %s AND id > %s)".format(name=orderBy)
+                    params.extend((value, value, itemId))
+            sql += " ORDER BY {name} NULLS FIRST, id LIMIT %s;".format(name=orderBy)
+        params.append(limit)
+        cursor = self.cursor
+        cursor.execute(sql, params)
+        return [self._makeItem(row) for row in cursor.fetchall()]
+
+    def streamItems(self, where=None, batchSize=None):
+        if where is None:
+            return self._streamRows(self._getAllSql, (), batchSize or self.streamBatchSize, self._makeItem)
+        params = []
+        sql = self._filterSql.format(condition=where.toSql(params, "%s"))
+        return self._streamRows(sql, params, batchSize or self.streamBatchSize, self._makeItem)
+
+    def _streamRows(self, sql, params, batchSize, func):
+        """Yields func(row) for all rows of a query, fetching batchSize rows at a time
+
+        A server-side (named) cursor is used, so the result is never materialized on the client;
+        it is closed as soon as the generator is exhausted or closed
+        """
+        cursor = self.connection.cursor(name="{}_stream_{}".format(self.tblName, next(self._streamIds)))
+        cursor.itersize = batchSize
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(batchSize)
+            while rows:
+                for row in rows:
+                    yield func(row)
+                rows = cursor.fetchmany(batchSize)
+        finally:
+            cursor.close()
 
     def clear(self):
         self.cursor.execute(self._clearSql)
@@ -206,6 +361,8 @@ class PgSqlTable(object):
 
 
 class ContainerEngine(PgSqlTable, AbstractContainerEngine):
+    supportsRankCounts = True
+
     def __init__(self, container):
         AbstractContainerEngine.__init__(self, container)
         PgSqlTable.__init__(self, container.realName, container.entityCls)
@@ -218,52 +375,60 @@ class ContainerEngine(PgSqlTable, AbstractContainerEngine):
     def createTableSchema(self):
         return PgSqlTable.createTableSchema(self) + self._metas.createTableSchema()
 
+    def upgradeTableSchema(self):
+        return PgSqlTable.upgradeTableSchema(self) + self._metas.upgradeTableSchema()
+
     def addItem(self, item):
         item.id = PgSqlTable.addItem(self, item)
         self._metas.insertItem(MetaItem(id=item.id, lastUpdate=self.container.database.currentDateTime()))
         return item.id
 
-    def _insertOrSetMetasGen(self, items, lastUpdate, deleted):
-        for item in items:
-            yield item
-            try:
-                self._metas.insertItem(MetaItem(id=item.id, lastUpdate=lastUpdate, deleted=deleted))
-            except ItemError:
-                self._metas.setItem(MetaItem(id=item.id, lastUpdate=lastUpdate, deleted=deleted))
+    def _upsertMetas(self, itemIds, deleted=False):
+        lastUpdate = self.container.database.currentDateTime()
+        self._metas.upsertItems([MetaItem(id=itemId, lastUpdate=lastUpdate, deleted=deleted) for itemId in itemIds])
 
     def addItems(self, items):
-        return PgSqlTable.addItems(
-            self, self._insertOrSetMetasGen(items, self.container.database.currentDateTime(), False)
-        )
+        items = list(items)
+        itemIds = list(PgSqlTable.addItems(self, items))
+        self._upsertMetas(itemIds)
+        return itemIds
 
     def insertItem(self, item):
         PgSqlTable.insertItem(self, item)
-        try:
-            self._metas.insertItem(MetaItem(id=item.id, lastUpdate=self.container.database.currentDateTime()))
-        except ItemError:
-            self._metas.setItem(MetaItem(id=item.id, lastUpdate=self.container.database.currentDateTime()))
+        self.advanceSequence((item.id,))
+        self._upsertMetas((item.id,))
 
     def insertItems(self, items):
-        PgSqlTable.insertItems(self, self._insertOrSetMetasGen(items, self.container.database.currentDateTime(), False))
+        items = list(items)
+        PgSqlTable.insertItems(self, items)
+        self.advanceSequence(item.id for item in items)
+        self._upsertMetas(item.id for item in items)
+
+    def upsertItems(self, items):
+        items = list(items)
+        PgSqlTable.upsertItems(self, items)
+        self.advanceSequence(item.id for item in items)
+        self._upsertMetas(item.id for item in items)
 
     def setItem(self, item):
+        if not self.changedFields(item):
+            return
         PgSqlTable.setItem(self, item)
-        self._metas.setItem(MetaItem(id=item.id, lastUpdate=self.container.database.currentDateTime()))
+        self._upsertMetas((item.id,))
 
     def setItems(self, items):
-        PgSqlTable.setItems(self, self._insertOrSetMetasGen(items, self.container.database.currentDateTime(), False))
+        items = [item for item in items if self.changedFields(item)]
+        PgSqlTable.setItems(self, items)
+        self._upsertMetas(item.id for item in items)
 
     def removeItem(self, itemId):
         PgSqlTable.removeItem(self, itemId)
-        self._metas.setItem(MetaItem(id=itemId, lastUpdate=self.container.database.currentDateTime(), deleted=True))
-
-    def _setMetasDeletedGen(self, itemIds, lastUpdate):
-        for itemId in itemIds:
-            yield itemId
-            self._metas.setItem(MetaItem(id=itemId, lastUpdate=lastUpdate, deleted=True))
+        self._upsertMetas((itemId,), deleted=True)
 
     def removeItems(self, itemIds):
-        PgSqlTable.removeItems(self, self._setMetasDeletedGen(itemIds, self.container.database.currentDateTime()))
+        itemIds = list(itemIds)
+        PgSqlTable.removeItems(self, itemIds)
+        self._upsertMetas(itemIds, deleted=True)
 
     def update(self):
         pass
@@ -275,8 +440,58 @@ class ContainerEngine(PgSqlTable, AbstractContainerEngine):
         return self._metas.allItems()
 
     def filterItems(self, check):
-        print("Filter now")
-        return filter(check, self.allItems())
+        return PgSqlTable.filter(self, check)
+
+    def rankCounts(self, ranks, flag):
+        # One GROUP BY per rank, each running over an index (flag, rank) if declared (see EntityMeta __indexes__)
+        sql = " UNION ALL ".join(
+            [
+                "SELECT 0, CAST({flag} AS INTEGER), COUNT(*) FROM {tblName} GROUP BY {flag}".format(
+                    flag=flag, tblName=self.tblName
+                )
+            ]
+            + [
+                "SELECT {rank}, {name}, COUNT(*) FROM {tblName} WHERE {flag} = %s AND {name} IS NOT NULL "
+                "GROUP BY {name}".format(rank=rank, name=name, flag=flag, tblName=self.tblName)
+                for rank, name in enumerate(ranks, 1)
+            ]
+        )
+        self.cursor.execute(sql + ";", (True,) * len(ranks))
+        return rankCountsFromRows(self.cursor.fetchall())
+
+    def select(self, names, where=None):
+        if where is not None and not isinstance(where, Expression):
+            return AbstractContainerEngine.select(self, names, where)
+        params = []
+        sql = "SELECT {cols} FROM {tblName}".format(cols=", ".join(names), tblName=self.tblName)
+        if where is not None:
+            sql += " WHERE " + where.toSql(params, "%s")
+        cursor = self.connection.cursor()
+        cursor.execute(sql + ";", params)
+        return cursor  # psycopg2 cursors yield tuples
+
+    def aggregate(self, groupBy, count, sums, where=None):
+        if where is not None and not isinstance(where, Expression):
+            return AbstractContainerEngine.aggregate(self, groupBy, count, sums, where)
+        sumCols = tuple(
+            "SUM(CAST({} AS INTEGER))".format(name)
+            if isinstance(self.entityCls.attributes[name], BoolAttribute)
+            else "SUM({})".format(name)
+            for name in sums
+        )
+        params = []
+        sql = "SELECT {cols} FROM {tblName}".format(
+            cols=", ".join(groupBy + ("COUNT(*)",) + sumCols), tblName=self.tblName
+        )
+        if where is not None:
+            sql += " WHERE " + where.toSql(params, "%s")
+        if groupBy:
+            sql += " GROUP BY " + ", ".join(groupBy)
+        self.cursor.execute(sql + ";", params)
+        return [
+            aggregateRow(groupBy, row[: len(groupBy)], count, sums, row[len(groupBy) :])
+            for row in self.cursor.fetchall()
+        ]
 
     # def allItems(self):
     # 	return PgSqlTable.allItems(self)
@@ -323,6 +538,9 @@ class PgSqlEngine(AbstractDatabaseEngine):
             container.engine.configConnection()
         if new:
             self.connection.cursor().execute(self.createSchema())
+        else:  # Sequences and indexes may have been added after the database was created
+            self.connection.cursor().execute(self.upgradeSchema())
+        self.commit()
         return new
 
     def close(self):
@@ -332,6 +550,20 @@ class PgSqlEngine(AbstractDatabaseEngine):
     def commit(self):
         self.connection.commit()
 
+    def rollback(self):
+        self.connection.rollback()
+
+    def savepoint(self, name):  # psycopg2 begins the enclosing transaction by itself
+        self.connection.cursor().execute("SAVEPOINT {};".format(name))
+
+    def releaseSavepoint(self, name):
+        self.connection.cursor().execute("RELEASE SAVEPOINT {};".format(name))
+
+    def rollbackToSavepoint(self, name):
+        cursor = self.connection.cursor()
+        cursor.execute("ROLLBACK TO SAVEPOINT {};".format(name))
+        cursor.execute("RELEASE SAVEPOINT {};".format(name))
+
     def checkAccess(self):
         return True
 
@@ -341,9 +573,12 @@ class PgSqlEngine(AbstractDatabaseEngine):
     def createSchema(self):
         sql = ""
         for container in self.database.containers.values():
-            container.engine.createTableSchema()
+            sql += container.engine.createTableSchema()
         return sql
 
+    def upgradeSchema(self):
+        return "".join(container.engine.upgradeTableSchema() for container in self.database.containers.values())
+
     @property
     def connection(self):
         return self._connection
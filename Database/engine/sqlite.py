@@ -1,12 +1,22 @@
 import collections
+import contextlib
+import itertools
+import json
+import operator
 import os
 import sqlite3.dbapi2 as sqlite3
 import threading
+import time
+import urllib.parse
+import weakref
 
 from .. import core, tools
 
 
 class ContainerEngine(core.AbstractContainerEngine):
+    maxVariables = 999  # SQLITE_MAX_VARIABLE_NUMBER of older sqlite versions
+    supportsRankCounts = True
+    supportsMaterializedRankCounts = True
     attrTypes = {
         core.IntAttribute: "INTEGER",
         core.StringAttribute: "TEXT",
@@ -18,9 +28,10 @@ class ContainerEngine(core.AbstractContainerEngine):
 
     def __init__(self, container):
         core.AbstractContainerEngine.__init__(self, container)
-        self._cursors = collections.defaultdict(self._createCursor)
+        self._cursors = {}  # {connection: cursor}, a connection is used by a single thread at a time
         self.entityCls = self.container.entityCls
         self.colNames = self.entityCls.attributes.keys()
+        self._materialized = None  # (ranks, flag) of the tally table (see materializeRankCounts)
         self._createSql()
 
     def addItem(self, item):
@@ -28,17 +39,19 @@ class ContainerEngine(core.AbstractContainerEngine):
         return self.cursor.lastrowid
 
     def addItems(self, items):
-        items = iter(items)
-        self.cursor.execute(self._addSql, self._makeVals(next(items)))
-        idStart = self.cursor.lastrowid
-        l = [1]
+        """Adds the items with explicitly assigned ids, so the returned ids are exact
 
-        def fun(item):
-            l[0] += 1
-            return self._makeVals(item)
-
-        self.cursor.executemany(self._addSql, map(fun, items))
-        return range(idStart, idStart + l[0])
+        The ids continue after the current maximum (just like sqlite's own rowid assignment) and are read
+        while holding the write lock, so neither concurrent writers nor a removed maximum row can shift them.
+        """
+        items = list(items)
+        with self._atomic():  # Writing threads begin their transactions with the write lock (see SqliteEngine.begin)
+            self.cursor.execute(self._nextIdSql)
+            idStart = self.cursor.fetchone()[0]
+            for itemId, item in enumerate(items, idStart):
+                item.id = itemId
+            self.cursor.executemany(self._insertSql, map(self._makeVals, items))
+        return range(idStart, idStart + len(items))
 
     def getItem(self, itemId):
         self.cursor.execute(self._getSql, (itemId,))
@@ -48,8 +61,59 @@ class ContainerEngine(core.AbstractContainerEngine):
         return self._makeItem(row)
 
     def getItems(self, itemIds):
-        for itemId in itemIds:
-            yield self.getItem(itemId)
+        """Returns the items in the requested order, fetched with as few queries as possible"""
+        itemIds = list(itemIds)
+        items = self.fetchItems(dict.fromkeys(itemIds))
+        try:
+            return [items[itemId] for itemId in itemIds]
+        except KeyError as e:
+            raise core.ItemError(e.args[0], core.ItemError.notExistingTxt) from None
+
+    def fetchItems(self, itemIds):
+        items = {}
+        for row in self._queryIds(itemIds, self._getManySql, self._getJsonSql):
+            item = self._makeItem(row)
+            items[item.id] = item
+        return items
+
+    def existingIds(self, itemIds):
+        """Returns the set of those ids which exist, checked with as few queries as possible"""
+        return {row[0] for row in self._queryIds(itemIds, self._getIdsInSql, self._getIdsJsonSql)}
+
+    def _queryIds(self, itemIds, inSql, jsonSql):
+        """Runs a query for many ids: a single one with the ids as a json array (unpacked by json_each),
+        or, for at most maxVariables ids or without json support, in IN lists of maxVariables ids each
+
+        Nothing is written (unlike with a temporary table of the ids), so no transaction is begun.
+        :return: a list of all rows
+        """
+        itemIds = list(itemIds)
+        cursor = self.cursor
+        if len(itemIds) > self.maxVariables:
+            try:
+                cursor.execute(jsonSql, (json.dumps(itemIds),))
+                return cursor.fetchall()
+            except sqlite3.OperationalError:  # sqlite built without json_each
+                pass
+        rows = []
+        for start in range(0, len(itemIds), self.maxVariables):
+            chunk = itemIds[start : start + self.maxVariables]
+            cursor.execute(inSql.format(params=", ".join("?" * len(chunk))), chunk)
+            rows.extend(cursor.fetchall())
+        return rows
+
+    @contextlib.contextmanager
+    def _atomic(self):
+        """Makes a bulk statement all-or-nothing within the current transaction"""
+        engine = self.mainEngine
+        engine.begin()
+        engine.savepoint("qvc_bulk")
+        try:
+            yield
+        except BaseException:
+            engine.rollbackToSavepoint("qvc_bulk")
+            raise
+        engine.releaseSavepoint("qvc_bulk")
 
     def insertItem(self, item):
         try:
@@ -57,50 +121,230 @@ class ContainerEngine(core.AbstractContainerEngine):
         except sqlite3.IntegrityError:
             raise core.ItemError(item.id, core.ItemError.alreadyExistingTxt)
 
-    def _checkItemsNotExistGen(self, items):
-        for item in items:
-            self._assertNotExists(item.id)
-            yield self._makeVals(item)
-
     def insertItems(self, items):
-        self.cursor.executemany(self._insertSql, self._checkItemsNotExistGen(items))
+        items = list(items)
+        with self._atomic():  # Checked with the write lock held, so no other writer can interfere
+            self._assertNoneExist(item.id for item in items)
+            try:
+                self.cursor.executemany(self._insertSql, [self._makeVals(item) for item in items])
+            except sqlite3.IntegrityError as e:  # Some other unique index
+                raise core.ItemError(None, str(e)) from None
 
     def setItem(self, item):
+        fields = self.changedFields(item)
+        if not fields:  # Nothing changed since the item was loaded
+            return
         self._assertExists(item.id)
-        self.cursor.execute(self._setSql, self._makeVals(item))
-
-    def _checkItemsExistGen(self, items):
-        for item in items:
-            self._assertExists(item.id)
-            yield self._makeVals(item)
+        self.cursor.execute(self._setSqlFor(fields), self._makeSetVals(item, fields))
 
     def setItems(self, items):
-        self.cursor.executemany(self._setSql, self._checkItemsExistGen(items))
+        changed = [(fields, item) for fields, item in ((self.changedFields(item), item) for item in items) if fields]
+        with self._atomic():  # Checked with the write lock held, so no other writer can interfere
+            self._assertAllExist(item.id for _, item in changed)
+            # Consecutive items changing the same columns share one executemany (and keep their order)
+            for fields, group in itertools.groupby(changed, key=lambda pair: pair[0]):
+                self.cursor.executemany(self._setSqlFor(fields), [self._makeSetVals(item, fields) for _, item in group])
+
+    def upsertItems(self, items):
+        """Inserts or completely overwrites the items at their ids with a single executemany"""
+        try:
+            self.cursor.executemany(self._upsertSql, [self._makeVals(item) for item in items])
+        except sqlite3.IntegrityError as e:  # Some other unique index
+            raise core.ItemError(None, str(e)) from None
 
     def removeItem(self, itemId):
         self._assertExists(itemId)
         self.cursor.execute(self._removeSql, (itemId,))
 
-    def _checkIdsExistGen(self, itemIds):
-        for itemId in itemIds:
-            self._assertExists(itemId)
-            yield itemId
-
     def removeItems(self, itemIds):
-        self.cursor.executemany(self._removeSql, self._checkIdsExistGen(itemIds))
+        itemIds = list(itemIds)
+        with self._atomic():  # Checked with the write lock held, so no other writer can interfere
+            self._assertAllExist(itemIds)
+            self.cursor.executemany(self._removeSql, [(itemId,) for itemId in itemIds])
 
     def filterItems(self, check):
-        return filter(check, self.allItems())
+        if not isinstance(check, core.Expression):
+            return filter(check, self.allItems())
+        return self.streamItems(check)  # A cursor of its own, so the items may be set while iterating
+
+    def aggregate(self, groupBy, count, sums, where=None):
+        if where is not None and not isinstance(where, core.Expression):
+            return core.AbstractContainerEngine.aggregate(self, groupBy, count, sums, where)
+        params = []
+        sql = "SELECT {cols} FROM {tblName}".format(
+            cols=", ".join(groupBy + ("COUNT(*)",) + tuple("SUM({})".format(name) for name in sums)),
+            tblName=self.tblName,
+        )
+        if where is not None:
+            sql += " WHERE " + where.toSql(params)
+        if groupBy:
+            sql += " GROUP BY " + ", ".join(groupBy)
+        cursor = self.cursor
+        cursor.execute(sql + ";", params)
+        return [
+            core.aggregateRow(groupBy, row[: len(groupBy)], count, sums, row[len(groupBy) :])
+            for row in cursor.fetchall()
+        ]
+
+    def rankCounts(self, ranks, flag):
+        return core.rankCountsFromRows(self._countRanks(ranks, flag))
+
+    def _countRanks(self, ranks, flag):
+        # One GROUP BY per rank, each running over an index (flag, rank) if declared (see EntityMeta __indexes__)
+        sql = " UNION ALL ".join(
+            ["SELECT 0, {flag}, COUNT(*) FROM {tblName} GROUP BY {flag}".format(flag=flag, tblName=self.tblName)]
+            + [
+                "SELECT {rank}, {name}, COUNT(*) FROM {tblName} WHERE {flag} = ? AND {name} IS NOT NULL "
+                "GROUP BY {name}".format(rank=rank, name=name, flag=flag, tblName=self.tblName)
+                for rank, name in enumerate(ranks, 1)
+            ]
+        )
+        return self.mainEngine.connection.execute(sql + ";", (True,) * len(ranks))
+
+    def materializeRankCounts(self, ranks, flag):
+        """Keeps the rank counts in the table <tblName>_tally (rank, value, count), maintained by triggers
+
+        Rank 0 counts the items per flag value (1: set, 0: not set).
+        The triggers are (re)created every time, the table is filled only when it is created.
+        :return: True if the table was created newly
+        """
+        tally = self.tblName + "_tally"
+        connection = self.mainEngine.connection
+        new = not connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (tally,)).fetchall()
+        add = ["INSERT INTO {tally} (rank, value, count) VALUES (0, NEW.{flag} IS 1, 1)"] + [
+            "INSERT INTO {{tally}} (rank, value, count) SELECT {rank}, NEW.{name}, 1 "
+            "WHERE NEW.{{flag}} IS 1 AND NEW.{name} IS NOT NULL".format(rank=rank, name=name)
+            for rank, name in enumerate(ranks, 1)
+        ]
+        add = ["{} ON CONFLICT (rank, value) DO UPDATE SET count = count + 1;".format(sql) for sql in add]
+        remove = ["UPDATE {tally} SET count = count - 1 WHERE rank = 0 AND value = (OLD.{flag} IS 1);"] + [
+            "UPDATE {{tally}} SET count = count - 1 WHERE rank = {rank} AND value = OLD.{name} "
+            "AND OLD.{{flag}} IS 1;".format(rank=rank, name=name)
+            for rank, name in enumerate(ranks, 1)
+        ]
+        statements = [
+            "CREATE TABLE IF NOT EXISTS {tally} (rank INTEGER, value, count INTEGER, PRIMARY KEY (rank, value));",
+            "DROP TRIGGER IF EXISTS {tally}_insert;",
+            "DROP TRIGGER IF EXISTS {tally}_update;",
+            "DROP TRIGGER IF EXISTS {tally}_delete;",
+            "CREATE TRIGGER {tally}_insert AFTER INSERT ON {tblName} BEGIN " + " ".join(add) + " END;",
+            "CREATE TRIGGER {tally}_update AFTER UPDATE OF {cols} ON {tblName} BEGIN "
+            + " ".join(remove + add)
+            + " END;",
+            "CREATE TRIGGER {tally}_delete AFTER DELETE ON {tblName} BEGIN " + " ".join(remove) + " END;",
+        ]
+        with self._atomic():  # Not executescript(), it would commit first
+            for sql in statements:
+                connection.execute(
+                    sql.format(tally=tally, tblName=self.tblName, flag=flag, cols=", ".join(ranks + (flag,)))
+                )
+            if new:
+                self._fillTally(tally, self._tallyRows(ranks, flag))
+        self._materialized = (ranks, flag)
+        return new
+
+    def _tallyRows(self, ranks, flag):
+        """The current rank counts as rows of the tally table, {(rank, value): count}"""
+        rows = collections.Counter()
+        for rank, value, count in self._countRanks(ranks, flag):
+            rows[(rank, int(value == 1) if rank == 0 else value)] += count  # The flag values like the triggers
+        return rows
+
+    def _fillTally(self, tally, rows):
+        self.cursor.execute("DELETE FROM {};".format(tally))
+        self.cursor.executemany(
+            "INSERT INTO {} (rank, value, count) VALUES (?, ?, ?);".format(tally),
+            ((rank, value, count) for (rank, value), count in rows.items()),
+        )
+
+    def readRankCounts(self):
+        if self._materialized is None:
+            return None
+        rows = self.mainEngine.connection.execute(
+            "SELECT rank, value, count FROM {}_tally WHERE count != 0;".format(self.tblName)
+        )
+        return core.rankCountsFromRows(rows)
+
+    def rebuildRankCounts(self):
+        if self._materialized is None:
+            return None
+        tally = self.tblName + "_tally"
+        with self._atomic():
+            actual = self._tallyRows(*self._materialized)
+            stored = {
+                (rank, value): count
+                for rank, value, count in self.mainEngine.connection.execute(
+                    "SELECT rank, value, count FROM {} WHERE count != 0;".format(tally)
+                )
+            }
+            self._fillTally(tally, actual)
+        return {
+            key: (stored.get(key, 0), actual.get(key, 0))
+            for key in stored.keys() | actual.keys()
+            if stored.get(key, 0) != actual.get(key, 0)
+        }
+
+    def select(self, names, where=None):
+        if where is not None and not isinstance(where, core.Expression):
+            return core.AbstractContainerEngine.select(self, names, where)
+        params = []
+        sql = "SELECT {cols} FROM {tblName}".format(cols=", ".join(names), tblName=self.tblName)
+        if where is not None:
+            sql += " WHERE " + where.toSql(params)
+        return self.mainEngine.connection.execute(sql + ";", params)  # A cursor of its own, yielding tuples
 
     def itemIds(self):
-        self.cursor.execute(self._getIdsSql)
-        for row in iter(self.cursor.fetchone, None):
-            yield row[0]
+        return self._streamRows(self._getIdsSql, (), self.streamBatchSize, operator.itemgetter(0))
 
     def allItems(self):
-        cursor = self.cursor  # So the cursor-property getter doesn't get called so often
-        cursor.execute(self._getAllSql)
-        return map(self._makeItem, iter(self.cursor.fetchone, None))
+        return self._streamRows(self._getAllSql, (), self.streamBatchSize, self._makeItem)
+
+    def page(self, afterId, limit, orderBy="id"):
+        params = []
+        sql = "SELECT * FROM {tblName}".format(tblName=self.tblName)
+        if orderBy == "id":
+            if afterId is not None:
+                sql += " WHERE id > ?"
+                params.append(afterId)
+            sql += " ORDER BY id LIMIT ?;"
+        else:
+            if afterId is not None:  # NULL values come first (a row value comparison would skip them)
+                value, itemId = afterId
+                if value is None:
+                    sql += " WHERE ({name} IS NULL AND id > ?) OR {name} IS NOT NULL".format(name=orderBy)
+                    params.append(itemId)
+                else:
+                    sql += " WHERE {name} > ? OR ({name} = ? AND id > ?)".format(name=orderBy)
+                    params.extend((value, value, itemId))
+            sql += " ORDER BY {name}, id LIMIT ?;".format(name=orderBy)
+        params.append(limit)
+        cursor = self.cursor
+        cursor.execute(sql, params)
+        return [self._makeItem(row) for row in cursor.fetchall()]
+
+    def streamItems(self, where=None, batchSize=None):
+        if where is None:
+            return self._streamRows(self._getAllSql, (), batchSize or self.streamBatchSize, self._makeItem)
+        params = []
+        sql = self._filterSql.format(condition=where.toSql(params))
+        return self._streamRows(sql, params, batchSize or self.streamBatchSize, self._makeItem)
+
+    def _streamRows(self, sql, params, batchSize, func):
+        """Yields func(row) for all rows of a query, fetching batchSize rows at a time
+
+        A cursor of its own is used (so other statements may run in between), it is closed
+        as soon as the generator is exhausted or closed
+        """
+        cursor = self.mainEngine.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(batchSize)
+            while rows:
+                for row in rows:
+                    yield func(row)
+                rows = cursor.fetchmany(batchSize)
+        finally:
+            cursor.close()
 
     def clear(self):
         self.cursor.execute(self._clearSql)
@@ -124,7 +368,25 @@ class ContainerEngine(core.AbstractContainerEngine):
                     name=name, type=ContainerEngine.fieldType(attr), default=attr.intern_default
                 )
             )
-        return "CREATE TABLE IF NOT EXISTS {tblName} ({fields});".format(tblName=self.tblName, fields=", ".join(fields))
+        return (
+            "CREATE TABLE IF NOT EXISTS {tblName} ({fields});".format(tblName=self.tblName, fields=", ".join(fields))
+            + self.createIndexSchema()
+        )
+
+    def createIndexSchema(self):
+        """The indexes of all attributes declared with index=True or unique=True"""
+        return "".join(
+            "CREATE {unique}INDEX IF NOT EXISTS {tblName}_{name}_idx ON {tblName} ({name});".format(
+                unique="UNIQUE " if attr.unique else "", tblName=self.tblName, name=name
+            )
+            for name, attr in self.entityCls.attributes.items()
+            if attr.index and name != "id"
+        ) + "".join(
+            "CREATE INDEX IF NOT EXISTS {tblName}_{name}_idx ON {tblName} ({cols});".format(
+                tblName=self.tblName, name="_".join(index), cols=", ".join(index)
+            )
+            for index in self.entityCls.__indexes__
+        )
 
     def _createSql(self):
         """pre-defines all sql statements, so it works faster"""
@@ -139,34 +401,63 @@ class ContainerEngine(core.AbstractContainerEngine):
             fields=", ".join(self.colNames),
             values=", ".join(":" + name for name in self.colNames),
         )
-        self._setSql = "UPDATE {tblName} SET {fields} WHERE id=:id;".format(
+        self._setSqls = {}  # {fields: sql} (see _setSqlFor)
+        self._setSql = self._setSqlFor(tuple(name for name in self.colNames if name != "id"))
+        updates = ", ".join("{name}=excluded.{name}".format(name=name) for name in self.colNames if name != "id")
+        self._upsertSql = "INSERT INTO {tblName} ({fields}) VALUES ({values}) ON CONFLICT(id) DO {update};".format(
             tblName=self.tblName,
-            fields=", ".join("{name}=:{name}".format(name=name) for name in self.colNames if name != "id"),
+            fields=", ".join(self.colNames),
+            values=", ".join(":" + name for name in self.colNames),
+            update="UPDATE SET " + updates if updates else "NOTHING",
         )
         self._getSql = "SELECT * FROM {tblName} WHERE id=?;".format(tblName=self.tblName)
-        self._getManySql = "SELECT * FROM {tblName} WHERE id in (?);".format(tblName=self.tblName)
+        self._getManySql = "SELECT * FROM {tblName} WHERE id IN ({{params}});".format(tblName=self.tblName)
+        self._getJsonSql = "SELECT * FROM {tblName} WHERE id IN (SELECT value FROM json_each(?));".format(
+            tblName=self.tblName
+        )
+        self._getIdsInSql = "SELECT id FROM {tblName} WHERE id IN ({{params}});".format(tblName=self.tblName)
+        self._getIdsJsonSql = "SELECT id FROM {tblName} WHERE id IN (SELECT value FROM json_each(?));".format(
+            tblName=self.tblName
+        )
         self._getAllSql = "SELECT * FROM {tblName};".format(tblName=self.tblName)
-        self._getIdsSql = "SELECT id FROM {tblName};".format(tblName=self.tblName)
+        self._filterSql = "SELECT * FROM {tblName} WHERE {{condition}};".format(tblName=self.tblName)
+        self._getIdsSql = "SELECT id FROM {tblName} ORDER BY id;".format(tblName=self.tblName)
         self._checkItemSql = "SELECT id FROM {tblName} WHERE id=? LIMIT 1;".format(tblName=self.tblName)
         self._countSql = "SELECT COUNT (*) FROM {tblName};".format(tblName=self.tblName)
+        # sqlite assigns max(rowid) + 1 as well, starting at 1
+        self._nextIdSql = "SELECT COALESCE(MAX(id), 0) + 1 FROM {tblName};".format(tblName=self.tblName)
         self._removeSql = "DELETE FROM {tblName} WHERE id=?;".format(tblName=self.tblName)
         # noinspection SqlWithoutWhere
         self._clearSql = "DELETE FROM {tblName};".format(tblName=self.tblName)
 
+    def _setSqlFor(self, fields):
+        """Returns an UPDATE statement writing only the given columns"""
+        try:
+            return self._setSqls[fields]
+        except KeyError:
+            sql = self._setSqls[fields] = "UPDATE {tblName} SET {fields} WHERE id=:id;".format(
+                tblName=self.tblName, fields=", ".join("{name}=:{name}".format(name=name) for name in fields)
+            )
+            return sql
+
     def _makeVals(self, item):
         return {name: getattr(item, name) for name in self.colNames}
 
+    @staticmethod
+    def _makeSetVals(item, fields):
+        vals = {name: getattr(item, name) for name in fields}
+        vals["id"] = item.id
+        return vals
+
     def _makeItem(self, data):
-        return self.entityCls(**dict(zip(self.colNames, data)))
+        item = self.entityCls(**dict(zip(self.colNames, data)))
+        item.markClean()
+        return item
 
     def _assertExists(self, itemId):
         if not self.checkItemExists(itemId):
             raise core.ItemError(itemId, core.ItemError.notExistingTxt)
 
-    def _assertNotExists(self, itemId):
-        if self.checkItemExists(itemId):
-            raise core.ItemError(itemId, core.ItemError.alreadyExistingTxt)
-
     @staticmethod
     def fieldType(attr):
         tp = tools.isinstancePool(attr, ContainerEngine.attrTypes)
@@ -178,13 +469,19 @@ class ContainerEngine(core.AbstractContainerEngine):
     def cursor(self):
         """Returns a sqlite3.Cursor for this table
 
-        Returns a cursor object for this thread;
+        Returns a cursor object of this thread's connection;
         if necessary, a new one is created
         """
-        return self._cursors[threading.get_ident()]
+        connection = self.mainEngine.connection
+        try:
+            return self._cursors[connection]
+        except KeyError:
+            cursor = self._cursors[connection] = connection.cursor()
+            return cursor
 
-    def _createCursor(self):
-        return self.mainEngine.connection.cursor()
+    def closeCursors(self):
+        """Forgets the cursors of all connections (called when the engine is closed)"""
+        self._cursors.clear()
 
     tblName = property(lambda self: self.entityCls.__realName__)
 
@@ -192,17 +489,310 @@ class ContainerEngine(core.AbstractContainerEngine):
 # entityCls=property(lambda self: self.container.entityCls) #too slow
 
 
+class ConnectionPool(object):
+    """Hands out one connection per thread, keeping at most maxSize connections
+
+    A thread keeps its connection until it calls release() or exits; connections of exited
+    threads are reclaimed (rolled back) and handed out again. An exit is noticed when the
+    thread's thread-local data is freed, so this also works for threads started outside
+    of python's threading module (e.g. QThreads, which is_alive() reports alive forever).
+    So at most maxSize threads can use the database at once: long-lived threads (e.g. one per
+    client connection) have to call release() when they go idle, or maxSize has to cover all of them.
+    If all connections are in use, get() waits up to timeout seconds (None: forever)
+    for one to become free and then raises a DatabaseError.
+    The connections have to be created with check_same_thread=False, since they change threads.
+    """
+
+    pollInterval = 0.05  # Waiting threads also look for exited threads regularly, in case no exit was noticed
+
+    def __init__(self, factory, maxSize=8, timeout=30.0):
+        """:param factory: a callable returning a new connection"""
+        self.factory = factory
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._generation = 0  # Increased by closeAll(), invalidating the connections remembered by the threads
+        self._owners = {}  # {thread ident: (thread, connection)}
+        self._idle = []
+        self.created = 0
+        self.reused = 0
+        self.reclaimed = 0
+        self.waits = 0
+
+    def get(self):
+        """Returns the connection of the calling thread (acquiring one if necessary)"""
+        local = self._local
+        if getattr(local, "generation", None) == self._generation:
+            return local.connection
+        with self._condition:
+            connection = self._acquire()
+            local.connection, local.generation = connection, self._generation
+            # Freed with the thread's thread-local data, i.e. when the thread exits
+            local.exitSentinel = _ExitSentinel()
+            finalizer = weakref.finalize(local.exitSentinel, self._threadExited, threading.get_ident(), connection)
+            finalizer.atexit = False  # Not for the threads still running at shutdown
+            return connection
+
+    def _threadExited(self, ident, connection):
+        with self._condition:
+            owner = self._owners.get(ident)
+            if owner is not None and owner[1] is connection:  # Not released (or closed) before
+                self._reclaim(ident)
+                self._condition.notify()
+
+    def _acquire(self):
+        thread = threading.current_thread()
+        owner = self._owners.get(thread.ident)
+        if owner is not None:
+            if owner[0] is thread:
+                return owner[1]
+            self._reclaim(thread.ident)  # The ident of an exited thread was reused
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not self._idle and len(self._owners) >= self.maxSize:
+            for ident, (owningThread, _) in list(self._owners.items()):
+                if not owningThread.is_alive():
+                    self._reclaim(ident)
+            if self._idle:
+                break
+            remaining = self.pollInterval
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.monotonic())
+            if remaining <= 0:
+                raise core.DatabaseError(
+                    "No free connection in the pool after {}s (maxSize={}); threads holding one have to "
+                    "release() it when idle, or the pool has to be larger".format(self.timeout, self.maxSize)
+                )
+            self.waits += 1
+            self._condition.wait(remaining)
+        if self._idle:
+            connection = self._idle.pop()
+            self.reused += 1
+        else:
+            connection = self.factory()
+            self.created += 1
+        self._owners[thread.ident] = (thread, connection)
+        return connection
+
+    def _reclaim(self, ident):
+        thread, connection = self._owners.pop(ident)
+        connection.rollback()  # Whatever the thread left uncommitted
+        self._idle.append(connection)
+        self.reclaimed += 1
+
+    def release(self):
+        """Gives the calling thread's connection back to the pool (uncommitted changes are rolled back)"""
+        with self._condition:
+            owner = self._owners.get(threading.get_ident())
+            if owner is not None and owner[0] is threading.current_thread():
+                self._reclaim(threading.get_ident())
+                self._condition.notify()
+            self._local.__dict__.clear()
+
+    def closeAll(self):
+        """Closes all connections, including those still held by other threads"""
+        with self._condition:
+            for thread, connection in self._owners.values():
+                connection.close()
+            for connection in self._idle:
+                connection.close()
+            self._owners.clear()
+            self._idle.clear()
+            self._generation += 1
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "inUse": len(self._owners),
+                "idle": len(self._idle),
+                "maxSize": self.maxSize,
+                "created": self.created,
+                "reused": self.reused,
+                "reclaimed": self.reclaimed,
+                "waits": self.waits,
+            }
+
+
+class _ExitSentinel(object):
+    """Stored thread-locally, so it is freed when its thread exits (see ConnectionPool)"""
+
+
+class DiskBackup(object):
+    """Copies an in-memory database to its file with sqlite's online backup, in a background thread
+
+    A backup is made every interval seconds if something was committed meanwhile,
+    or as soon as everyCommits commits are unsaved. Commits not yet copied are lost on a crash;
+    riskWindow() tells how many and for how long.
+    """
+
+    def __init__(self, source, openTarget, interval=2.0, everyCommits=None):
+        """:param source: a connection to the in-memory database, used only by the backup
+        :param openTarget: a callable returning a new connection to the file
+        :param interval: seconds between backups (None: only every everyCommits commits)
+        :param everyCommits: make a backup after that many commits (None: only by the timer)
+        """
+        self.source = source
+        self.openTarget = openTarget
+        self.interval = interval
+        self.everyCommits = everyCommits
+        self._lock = threading.Lock()  # Serializes the backups themselves
+        self._condition = threading.Condition()
+        self._unsaved = 0
+        self._unsavedSince = None  # time.monotonic() of the oldest unsaved commit
+        self._stopped = False
+        self.backups = 0
+        self.lastBackup = None  # time.time() when the last backup had finished
+        self.lastDuration = None
+        self.lastError = None
+        self._thread = threading.Thread(target=self._run, name="sqlite-backup", daemon=True)
+        self._thread.start()
+
+    def noteCommit(self):
+        with self._condition:
+            if not self._unsaved:
+                self._unsavedSince = time.monotonic()
+            self._unsaved += 1
+            if self.everyCommits is not None and self._unsaved >= self.everyCommits:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(self._isDue, self.interval)
+                if self._stopped:
+                    return
+                if not self._unsaved:
+                    continue
+            try:
+                self.flush()
+            except sqlite3.Error as e:  # Try again next time; riskWindow() keeps growing meanwhile
+                self.lastError = e
+
+    def _isDue(self):
+        return self._stopped or (self.everyCommits is not None and self._unsaved >= self.everyCommits)
+
+    def flush(self):
+        """Copies the committed state to the file right away (synchronously)"""
+        with self._lock:
+            with self._condition:
+                copied, startTime = self._unsaved, time.monotonic()
+            start = time.time()
+            target = self.openTarget()
+            try:
+                self.source.backup(target)
+            finally:
+                target.close()
+            with self._condition:
+                self._unsaved -= copied
+                # Commits made while copying may or may not be in the file, so they count as unsaved
+                self._unsavedSince = startTime if self._unsaved else None
+            self.backups += 1
+            self.lastBackup = time.time()
+            self.lastDuration = self.lastBackup - start
+            self.lastError = None
+
+    def riskWindow(self):
+        """Returns what a crash would lose now (a dict): the number of unsaved commits
+        and the age in seconds of the oldest of them (0 if everything is saved)
+        """
+        with self._condition:
+            return {
+                "commits": self._unsaved,
+                "seconds": time.monotonic() - self._unsavedSince if self._unsaved else 0.0,
+                "lastBackup": self.lastBackup,
+                "lastDuration": self.lastDuration,
+                "backups": self.backups,
+                "lastError": self.lastError,
+            }
+
+    def stop(self):
+        """Stops the thread and makes a final backup"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+
 class SqliteEngine(core.AbstractDatabaseEngine):
     """Implements sqlite3 support"""
 
-    def __init__(self):
-        """Initializes a new Engine object"""
+    pragmaNames = {  # open() option: pragma
+        "journalMode": "journal_mode",
+        "synchronous": "synchronous",
+        "busyTimeout": "busy_timeout",
+        "cacheSize": "cache_size",
+        "mmapSize": "mmap_size",
+        "tempStore": "temp_store",
+    }
+    presets = {
+        # Every committed ballot survives a crash or power loss; readers don't block the entry (WAL).
+        # With group commit (Database.setGroupCommit) ballots are only committed with their group though
+        "durable-entry": {
+            "journalMode": "WAL",
+            "synchronous": "FULL",
+            "busyTimeout": 5000,
+            "cacheSize": -16000,  # KiB
+            "tempStore": "MEMORY",
+        },
+        # Loading lots of data, which can simply be imported again if the machine crashes meanwhile
+        "fast-bulk-import": {
+            "journalMode": "WAL",
+            "synchronous": "OFF",
+            "busyTimeout": 5000,
+            "cacheSize": -262144,
+            "mmapSize": 268435456,
+            "tempStore": "MEMORY",
+        },
+    }
+    _memoryIds = itertools.count()  # For unique names of the in-memory databases
+
+    def __init__(self, poolSize=8, poolTimeout=30.0):
+        """Initializes a new Engine object
+
+        :param poolSize: the maximum number of connections, i.e. of threads using the database at once;
+            a thread keeps its connection until it exits or calls releaseConnection() (see ConnectionPool)
+        :param poolTimeout: seconds a thread waits for a free connection before a DatabaseError is raised
+            (None: forever)
+        """
         core.AbstractDatabaseEngine.__init__(self)
-        self._connections = collections.defaultdict(self._createConn)
+        self._pool = ConnectionPool(self._createConn, poolSize, poolTimeout)
+        self._readPool = ConnectionPool(self._createReadConn, poolSize, poolTimeout)
+        self._readers = threading.local()  # readers.active: the thread uses a read-only connection
         self._path = ""
+        self._pragmas = []
+        self._memoryUri = None  # Set while working in memory (see open)
+        self._memoryAnchor = None  # Keeps the in-memory database alive, also the source of the backups
+        self._backup = None
 
     def commit(self):
         self.connection.commit()
+        if self._backup is not None:
+            self._backup.noteCommit()
+
+    def begin(self):
+        """Starts a transaction; on the writing connections it takes the write lock right away
+
+        A deferred transaction would take a read snapshot first and then fail at once with
+        "database is locked" when its first write finds that another connection has written meanwhile
+        (the busy timeout doesn't help there). BEGIN IMMEDIATE waits for the lock instead.
+        """
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN;" if getattr(self._readers, "active", False) else "BEGIN IMMEDIATE;")
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def savepoint(self, name):
+        self.connection.execute("SAVEPOINT {};".format(name))
+
+    def releaseSavepoint(self, name):
+        self.connection.execute("RELEASE {};".format(name))
+
+    def rollbackToSavepoint(self, name):
+        self.connection.execute("ROLLBACK TO {};".format(name))
+        self.connection.execute("RELEASE {};".format(name))
 
     def checkAccess(self):
         pass
@@ -210,29 +800,172 @@ class SqliteEngine(core.AbstractDatabaseEngine):
     def createContainerEngine(self, container):
         return ContainerEngine(container)
 
-    def open(self, path):
+    def open(self, path, preset=None, inMemory=False, backupInterval=2.0, backupEveryCommits=None, **options):
+        """Opens (or creates) the database file
+
+        :param path: the path of the database file
+        :param preset: the name of a pragma preset (see presets), the options override its values
+        :param inMemory: work on an in-memory copy of the file (loaded if it exists), which is
+            written back to the file in the background (see DiskBackup) and on close()
+        :param backupInterval: seconds between the background backups (inMemory only)
+        :param backupEveryCommits: also make a backup after that many commits (inMemory only)
+        :param options: journalMode ("WAL", "DELETE", ...), synchronous ("OFF", "NORMAL", "FULL"),
+            busyTimeout (ms), cacheSize (pages, or KiB if negative), mmapSize (bytes)
+            and tempStore ("DEFAULT", "FILE", "MEMORY"); applied to every connection
+        :return: True if the file was created newly
+        """
+        if preset is not None and preset not in self.presets:
+            raise ValueError("Unknown preset {!r}, use one of {}".format(preset, tuple(self.presets)))
+        settings = dict(self.presets[preset]) if preset is not None else {}
+        settings.update(options)
+        for name in settings:
+            if name not in self.pragmaNames:
+                raise ValueError("Unknown option {!r}, use one of {}".format(name, tuple(self.pragmaNames)))
+        self._pragmas = ["PRAGMA {}={};".format(self.pragmaNames[name], value) for name, value in settings.items()]
         self._path = path
         new = not os.path.exists(self._path)
-        self._createConn()
+        if inMemory:
+            self._openMemory(new)
         if new:
             sql = "".join(cont.engine.createTableSchema() for cont in self.database.containers.values())
             print("EXEC SQL:", sql)
-            self.connection.executescript(sql)
-            self.commit()
+        else:  # Indexes may have been declared after the file was created
+            sql = "".join(cont.engine.createIndexSchema() for cont in self.database.containers.values())
+        self.connection.executescript(sql)
+        self.commit()
+        if inMemory:
+            self._backup = DiskBackup(self._memoryAnchor, self._createFileConn, backupInterval, backupEveryCommits)
+            self._backup.flush()  # The file exists (and has the schema) from the start
         return new
 
+    def _openMemory(self, new):
+        # The memdb vfs shares the database among the connections of this process with the usual locking
+        # (i.e. busyTimeout applies), unlike the table locks of a shared-cache ":memory:" database
+        if sqlite3.sqlite_version_info < (3, 36, 0):
+            raise core.DatabaseError("inMemory needs sqlite 3.36 or newer (found {})".format(sqlite3.sqlite_version))
+        self._memoryUri = "file:/qvc-memory-{}-{}?vfs=memdb".format(os.getpid(), next(self._memoryIds))
+        self._memoryAnchor = sqlite3.connect(self._memoryUri, uri=True, check_same_thread=False)
+        if not new:
+            self._loadIntoMemory()
+
+    def _loadIntoMemory(self):
+        """Copies the file into the in-memory database
+
+        Not with backup(): that would copy the WAL flag of the file header, which the memdb vfs can't open.
+        The indexes and triggers are created after copying the rows.
+        """
+        source = sqlite3.connect(
+            "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(self._path))), uri=True, isolation_level=None
+        )
+        try:
+            schema = source.execute(
+                "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%';"
+            ).fetchall()
+            tables = [(name, sql) for kind, name, sql in schema if kind == "table"]
+            self._memoryAnchor.executescript("".join(sql + ";" for name, sql in tables))
+            source.execute("ATTACH DATABASE ? AS memory;", (self._memoryUri,))
+            source.execute("BEGIN;")
+            for name, sql in tables:
+                source.execute('INSERT INTO memory."{name}" SELECT * FROM main."{name}";'.format(name=name))
+            source.execute("COMMIT;")
+            source.execute("DETACH DATABASE memory;")
+            self._memoryAnchor.executescript("".join(sql + ";" for kind, name, sql in schema if kind != "table"))
+        finally:
+            source.close()
+
     def close(self):
         self.commit()
-        self.connection.close()
+        for container in self.database.containers.values():
+            container.engine.closeCursors()
+        self._pool.closeAll()
+        self._readPool.closeAll()
+        if self._backup is not None:
+            self._backup.stop()  # Writes everything committed to the file
+            self._backup = None
+        if self._memoryAnchor is not None:
+            self._memoryAnchor.close()
+            self._memoryAnchor = self._memoryUri = None
+
+    def riskWindow(self):
+        """Returns what a crash would lose when working in memory (see DiskBackup.riskWindow), else None"""
+        if self._backup is None:
+            return None
+        return self._backup.riskWindow()
+
+    def backupNow(self):
+        """Writes the in-memory database to the file right away (does nothing for a file database)"""
+        if self._backup is not None:
+            self._backup.flush()
 
     @property
     def connection(self):  # "Public" attribute, so it is possible to execute sql-statements from outside
         """Returns a sqlite3.Connection object
 
         Returns the connection object for the current thread;
-        if necessary, a new one is created
+        if necessary, one is taken from the pool
         """
-        return self._connections[threading.get_ident()]
+        if getattr(self._readers, "active", False):
+            return self._readPool.get()
+        return self._pool.get()
+
+    @contextlib.contextmanager
+    def readOnly(self):
+        """Makes the calling thread read through a read-only connection within the with block
+
+        e.g. for reporting threads; in WAL mode they run concurrently with the writing threads,
+        each reading the last committed state. The connection is given back at the end of the block.
+        """
+        if getattr(self._readers, "active", False):  # Nested
+            yield
+            return
+        self._readers.active = True
+        try:
+            yield
+        finally:
+            self._readers.active = False
+            self._readPool.release()
+
+    def releaseConnection(self):
+        """Gives this thread's connection back to the pool, e.g. before a worker thread goes idle"""
+        self._pool.release()
+
+    def poolStats(self):
+        """Returns statistics of the connection pool (a dict)"""
+        return self._pool.stats()
 
     def _createConn(self):
-        return sqlite3.connect(self._path, detect_types=sqlite3.PARSE_DECLTYPES)
+        if self._memoryUri is not None:
+            return self._createMemoryConn()
+        return self._createFileConn()
+
+    def _createFileConn(self):
+        connection = sqlite3.connect(self._path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        for pragma in self._pragmas:
+            connection.execute(pragma)
+        return connection
+
+    def _createMemoryConn(self):
+        connection = sqlite3.connect(
+            self._memoryUri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False
+        )
+        for pragma in self._pragmas:
+            if not pragma.startswith("PRAGMA journal_mode"):  # Only for the file (see _createFileConn)
+                connection.execute(pragma)
+        return connection
+
+    def _createReadConn(self):
+        if self._memoryUri is not None:
+            connection = self._createMemoryConn()
+            connection.execute("PRAGMA query_only=1;")
+            return connection
+        connection = sqlite3.connect(
+            "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(self._path))),
+            uri=True,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+        )
+        for pragma in self._pragmas:
+            if not pragma.startswith("PRAGMA journal_mode"):  # Can't be changed by a read-only connection
+                connection.execute(pragma)
+        connection.execute("PRAGMA query_only=1;")
+        return connection
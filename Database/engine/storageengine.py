@@ -1,8 +1,9 @@
+import bisect
 import errno
 import os
 import struct
 
-from .base import AbstractDatabaseEngine, AbstractContainerEngine, ItemError, MetaItem
+from .base import AbstractDatabaseEngine, AbstractContainerEngine, ItemError, MetaItem, makePredicate
 from .datastream import DataStream
 from .itemstorage import ItemStorage
 
@@ -13,12 +14,20 @@ class StorageEngine(AbstractDatabaseEngine):
             AbstractContainerEngine.__init__(self, container)
             ItemStorage.__init__(self)
             self._metas = {}
+            self._indexes = {  # {name: {value: {itemId, ...}}} for attributes declared with index=True
+                name: {} for name, attr in container.entityCls.attributes.items() if attr.index and name != "id"
+            }
+            self._sortedIds = []  # For the keyset pagination (see page)
 
         def update(self):
             pass
 
         def addItem(self, item):
+            self._checkUnique(item)
             item.id = ItemStorage.addItem(self, item)
+            item.markClean()
+            self._indexItem(item)
+            bisect.insort(self._sortedIds, item.id)
             self._metas[item.id] = MetaItem(id=item.id, lastUpdate=self.container.database.currentDateTime())
             return item.id
 
@@ -29,7 +38,11 @@ class StorageEngine(AbstractDatabaseEngine):
         def insertItem(self, item):
             if item.id in self.itemIds():
                 raise ItemError(item.id)
+            self._checkUnique(item)
             ItemStorage.insertItem(self, item)
+            item.markClean()
+            self._indexItem(item)
+            bisect.insort(self._sortedIds, item.id)
             self._metas[item.id] = MetaItem(id=item.id, lastUpdate=self.container.database.currentDateTime())
 
         def insertItems(self, items):
@@ -46,25 +59,54 @@ class StorageEngine(AbstractDatabaseEngine):
             for itemId in itemIds:
                 yield self.getItem(itemId)
 
+        def fetchItems(self, itemIds):
+            return {itemId: self._data[itemId] for itemId in itemIds if itemId in self._data}
+
         def setItem(self, item):
-            if item.id not in self.itemIds():
-                raise ItemError(item.id)
-            ItemStorage.setItem(self, item)
+            fields = self.changedFields(item)
+            if not fields:  # Nothing changed since the item was loaded
+                return
+            try:
+                stored = self._data[item.id]
+            except KeyError:
+                raise ItemError(item.id) from None
+            self._checkUnique(item)
+            self._unindexItem(stored)
+            for name in fields:  # Only the changed attributes are patched into the stored item
+                setattr(stored, name, getattr(item, name))
+            stored.markClean()
+            self._indexItem(stored)
             self.metaItem(item.id).lastUpdate = self.container.database.currentDateTime()
 
         def setItems(self, items):
             for item in items:
                 self.setItem(item)
 
+        def upsertItems(self, items):
+            lastUpdate = self.container.database.currentDateTime()
+            for item in items:
+                self._checkUnique(item)
+                stored = self._data.get(item.id)
+                if stored is None:
+                    bisect.insort(self._sortedIds, item.id)
+                else:
+                    self._unindexItem(stored)
+                self._data[item.id] = item
+                item.markClean()
+                self._indexItem(item)
+                self._metas[item.id] = MetaItem(id=item.id, lastUpdate=lastUpdate)
+
         def removeItem(self, itemId):
             try:
+                self._unindexItem(self._data[itemId])
                 ItemStorage.removeItem(self, itemId)
             except KeyError:
                 raise ItemError(itemId) from None
+            del self._sortedIds[bisect.bisect_left(self._sortedIds, itemId)]
             self.metaItem(itemId).lastUpdate = self.container.database.currentDateTime()
             self.metaItem(itemId).deleted = True
 
-        def removeItems(self, *itemIds):
+        def removeItems(self, itemIds):
             for itemId in itemIds:
                 self.removeItem(itemId)
 
@@ -75,7 +117,7 @@ class StorageEngine(AbstractDatabaseEngine):
             return self._metas.values()
 
         def filterItems(self, check):
-            return filter(check, self.allItems())
+            return filter(makePredicate(check), self.allItems())  # Evaluated on the stored items in place
 
         def allItems(self):
             return ItemStorage.items(self)
@@ -86,6 +128,44 @@ class StorageEngine(AbstractDatabaseEngine):
         def clear(self):
             ItemStorage.clear(self)
             self._metas.clear()
+            self._sortedIds.clear()
+            for index in self._indexes.values():
+                index.clear()
+
+        def page(self, afterId, limit, orderBy="id"):
+            if orderBy != "id":
+                return AbstractContainerEngine.page(self, afterId, limit, orderBy)
+            start = 0 if afterId is None else bisect.bisect_right(self._sortedIds, afterId)
+            return [self._data[itemId] for itemId in self._sortedIds[start : start + limit]]
+
+        def findBy(self, name, value):
+            index = self._indexes.get(name)
+            if index is None:
+                return AbstractContainerEngine.findBy(self, name, value)
+            value = self.container.entityCls.attributes[name].internValue(value)
+            return [self._data[itemId] for itemId in index.get(value, ())]
+
+        def _indexValues(self, item):
+            attributes = self.container.entityCls.attributes
+            for name, index in self._indexes.items():
+                yield attributes[name], index, attributes[name].internValue(getattr(item, name))
+
+        def _checkUnique(self, item):
+            for attr, index, value in self._indexValues(item):
+                if attr.unique and index.get(value, set()) - {item.id}:
+                    raise ItemError(item.id, "{} {!r} is not unique".format(attr.name, value))
+
+        def _indexItem(self, item):
+            for attr, index, value in self._indexValues(item):
+                index.setdefault(value, set()).add(item.id)
+
+        def _unindexItem(self, item):
+            for attr, index, value in self._indexValues(item):
+                itemIds = index.get(value)
+                if itemIds is not None:
+                    itemIds.discard(item.id)
+                    if not itemIds:
+                        del index[value]
 
         def itemCount(self):
             return len(self._data)
@@ -114,9 +194,7 @@ class StorageEngine(AbstractDatabaseEngine):
         try:
             for container in self.database.containers:
                 itemCount = stream.readUInt16()
-                for i in range(itemCount):
-                    item = container.entityCls.readItem(stream.device)
-                    container.engine.insertItem(item)
+                container.engine.upsertItems([container.entityCls.readItem(stream.device) for i in range(itemCount)])
         except struct.error:
             raise IOError(errno.ENOMEM) from None
         return False
@@ -1,5 +1,5 @@
 class User(Entity):
-    name = StringAttribute("")
+    name = StringAttribute("", unique=True)
     password = StringAttribute("")
 
 
@@ -14,12 +14,12 @@ class Permission(Entity):
 
 
 class Membership(Entity):
-    userId = IntAttribute(-1)
+    userId = IntAttribute(-1, index=True)
     groupId = IntAttribute(-1)
 
 
 class PermissionAssignment(Entity):
-    groupId = IntAttribute(-1)
+    groupId = IntAttribute(-1, index=True)
     permissionId = IntAttribute(-1)
 
 
@@ -90,6 +90,9 @@ class _UAContainer(UAItemContainer):  # Adds possibilities to do stuff secretly
     def filterItemsSecretly(self, check):
         return self.engine.filterItems(check)
 
+    def findBySecretly(self, attr, value):
+        return self.engine.findBy(attr.name, value)
+
 
 class UADbClient(DbClient):
     def __init__(self, database, user):
@@ -148,22 +151,17 @@ class UADatabase(Database):
         return userId, groupId
 
     def getUserByName(self, userName):
-        for user in self.users.filterItemsSecretly(lambda usr: usr.name == userName):
+        for user in self.users.findBySecretly(User.name, userName):
             return user
         raise ItemError(-2)
 
     def getUserGroupsIds(self, userId):
-        return [
-            membership.groupId
-            for membership in self.memberships.filterItemsSecretly(lambda membership: membership.userId == userId)
-        ]
+        return [membership.groupId for membership in self.memberships.findBySecretly(Membership.userId, userId)]
 
     def getGroupPermissionsIds(self, groupId):
         return [
             assignment.permissionId
-            for assignment in self.permissionAssignments.filterItemsSecretly(
-                lambda assignment: assignment.groupId == groupId
-            )
+            for assignment in self.permissionAssignments.findBySecretly(PermissionAssignment.groupId, groupId)
         ]
 
     def checkUser(self, userName, password):
@@ -6,11 +6,14 @@ from Database.core import (
     AddItemEvent,
     AddItemsEvent,
     InsertItemEvent,
+    InsertItemsEvent,
     SetItemEvent,
+    SetItemsEvent,
     RemoveItemEvent,
+    RemoveItemsEvent,
+    UpsertItemsEvent,
     ClearEvent,
     UpdateEvent,
-    AbstractItemEvent,
 )
 
 
@@ -29,56 +32,84 @@ class QtModelWrapper(AbstractContainerEventFilter, QAbstractTableModel):
                 self._referenceContainers[col] = next(
                     filter(lambda c: c.entityCls == attr.entityCls, self.container.database.containers.values())
                 )
-        self._idsByRows = {}
+        self._idsByRows = []  # The item ids in row order
+        self._rowsByIds = {}
+        self._eventHandlers = {
+            AddItemEvent: self.addItemEvent,
+            AddItemsEvent: self.addItemsEvent,
+            InsertItemEvent: self.insertItemEvent,
+            InsertItemsEvent: self.insertItemsEvent,
+            SetItemEvent: self.setItemEvent,
+            SetItemsEvent: self.setItemsEvent,
+            RemoveItemEvent: self.removeItemEvent,
+            RemoveItemsEvent: self.removeItemsEvent,
+            UpsertItemsEvent: self.upsertItemsEvent,
+            UpdateEvent: self.updateEvent,
+            ClearEvent: self.clearEvent,
+        }
+        self.eventTypes = tuple(self._eventHandlers)  # The container only posts these to the wrapper
 
     def filterEvent(self, event):
-        if isinstance(event, AbstractItemEvent):
-            if isinstance(event, AddItemEvent):
-                self.addItemEvent(event)
-            elif isinstance(event, InsertItemEvent):
-                self.insertItemEvent(event)
-            elif isinstance(event, SetItemEvent):
-                self.setItemEvent(event)
-            elif isinstance(event, RemoveItemEvent):
-                self.removeItemEvent(event)
-        elif isinstance(event, AddItemsEvent):
-            self.addItemsEvent(event)
-        elif isinstance(event, UpdateEvent):
-            self.updateEvent(event)
-        elif isinstance(event, ClearEvent):
-            self.clearEvent(event)
+        self._eventHandlers[type(event)](event)
 
     def addItemEvent(self, event):
         # cli=self.container.currentClient
         # cli.releaseDb()
         self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
-        self._idsByRows[self.rowCount()] = event.itemId
+        self._appendRow(event.itemId)
         self.endInsertRows()
 
     # cli.acquireDb()
 
     def addItemsEvent(self, event):
+        if not event.itemIds:
+            return
         rowCount = self.rowCount()
-        self.beginInsertRows(QModelIndex(), rowCount, rowCount + len(event.itemIds))
-        for row, itemId in enumerate(event.itemIds, rowCount):
-            self._idsByRows[row] = itemId
+        self.beginInsertRows(QModelIndex(), rowCount, rowCount + len(event.itemIds) - 1)
+        for itemId in event.itemIds:
+            self._appendRow(itemId)
         self.endInsertRows()
 
+    def insertItemsEvent(self, event):
+        self.addItemsEvent(event)
+
     def insertItemEvent(self, event):
         self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
-        self._idsByRows[self.rowCount()] = event.itemId
+        self._appendRow(event.itemId)
         self.endInsertRows()
 
     def setItemEvent(self, event):
         row = self.rowById(event.itemId)
         self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
 
+    def setItemsEvent(self, event):
+        rows = [self.rowById(itemId) for itemId in event.itemIds]
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), 0), self.index(max(rows), self.columnCount() - 1))
+
+    def upsertItemsEvent(self, event):
+        rowCount = self.rowCount()
+        rows = [self._rowsByIds[itemId] for itemId in event.itemIds if itemId in self._rowsByIds]
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), 0), self.index(max(rows), self.columnCount() - 1))
+        newIds = [itemId for itemId in dict.fromkeys(event.itemIds) if itemId not in self._rowsByIds]
+        if newIds:
+            self.beginInsertRows(QModelIndex(), rowCount, rowCount + len(newIds) - 1)
+            for itemId in newIds:
+                self._appendRow(itemId)
+            self.endInsertRows()
+
     def removeItemEvent(self, event):
         row = self.rowById(event.itemId)
         self.beginRemoveRows(QModelIndex(), row, row)
         self.updateIdsByRows()  # Todo (only reposition items after that one)
         self.endRemoveRows()
 
+    def removeItemsEvent(self, event):
+        self.beginResetModel()
+        self.updateIdsByRows()
+        self.endResetModel()
+
     def updateEvent(self, event):
         self.repopulateModel()
 
@@ -151,18 +182,21 @@ class QtModelWrapper(AbstractContainerEventFilter, QAbstractTableModel):
         return attr.reprValue(getattr(item, self._headers[col]))
 
     def updateIdsByRows(self):
-        self._idsByRows.clear()
-        for row, itemId in enumerate(self.container.itemIds()):
-            self._idsByRows[row] = itemId
+        self._idsByRows = list(self.container.itemIds())  # Streamed by the engine
+        self._rowsByIds = {itemId: row for row, itemId in enumerate(self._idsByRows)}
+
+    def _appendRow(self, itemId):
+        self._rowsByIds[itemId] = len(self._idsByRows)
+        self._idsByRows.append(itemId)
 
     def idByRow(self, row):
         return self._idsByRows[row]
 
     def rowById(self, itemId):
-        for row in list(self._idsByRows.keys()):
-            if self.idByRow(row) == itemId:
-                return row
-        raise KeyError("Item not in table.")
+        try:
+            return self._rowsByIds[itemId]
+        except KeyError:
+            raise KeyError("Item not in table.") from None
 
     def idByIndex(self, index):
         return self._idsByRows[index.row()]
@@ -119,10 +119,7 @@ class VDBContainerEngine(StorageContainerEngine):
                 StorageContainerEngine.removeItem(self, meta.itemId)
             else:
                 item = self.container.entityCls.readItem(request.response)
-                if item in self.container:
-                    StorageContainerEngine.setItem(self, item)
-                else:
-                    StorageContainerEngine.insertItem(self, item)
+                StorageContainerEngine.upsertItems(self, (item,))
             self.meta(meta.itemId).lastUpdate = meta.lastUpdate
         self.lastUpdate = stream.readDateTime()
 
@@ -15,6 +15,7 @@ from Engine.UI import SimpleTextList, BLayoutHelper
 from Engine.ContainerView import ContainerView
 from Engine.QtUIWrapper import QtModelWrapper
 from Engine.Message import MessagePopup
+from Database.core import CoalescingEventFilter
 
 from .DbConfig import Vote, VoteGroup, Participant
 
@@ -29,7 +30,7 @@ class StatView(FigureCanvas):
 
         # with self.mainManager.dbManager.dbClient:
         participants = list(self.mainManager.dbManager.db.participants.allItems())
-        points, topVotes, voteCount, invalidVotes = self.mainManager.dbManager.db.calcPoints()
+        points, topVotes, voteCount, invalidVotes = self.mainManager.dbManager.db.readTally()
 
         # Points
         print(points, participants, topVotes)
@@ -75,7 +76,7 @@ class StatView(FigureCanvas):
         print("UpdateView")
         # with self.mainManager.dbManager.dbClient:
         participants = list(self.mainManager.dbManager.db.participants.allItems())
-        points, topVotes, voteCount, invalidVotes = self.mainManager.dbManager.db.calcPoints()
+        points, topVotes, voteCount, invalidVotes = self.mainManager.dbManager.db.readTally()
         self.pointsAxes.clear()
         self.pointsAxes.set_title("Points")
         self.pointsAxes.pie(
@@ -193,7 +194,7 @@ class VoteEditor(QWidget):
         # uiWrapper.setModelAccessClient(self.voteApp.appManager.mainManager.dbManager.dbClient)
         # with self.voteApp.appManager.mainManager.dbManager.dbClient:
         self.groupSelector.addItems(
-            [group.name for group in self.voteApp.appManager.mainManager.dbManager.db.voteGroups]
+            [name for (name,) in self.voteApp.appManager.mainManager.dbManager.db.voteGroups.select(VoteGroup.name)]
         )
 
         layout1 = QFormLayout()
@@ -239,7 +240,8 @@ class VoteEditor(QWidget):
             return
         if self.validate(vote):
             # with self.voteApp.appManager.mainManager.dbManager.dbClient:
-            self.voteApp.appManager.mainManager.dbManager.db.votes.addItem(vote)
+            with self.voteApp.appManager.mainManager.dbManager.db.do():
+                self.voteApp.appManager.mainManager.dbManager.db.votes.addItem(vote)
         else:
             MessagePopup.infoPopup(
                 self.voteApp.appManager.mainManager.mainWindow,
@@ -259,14 +261,15 @@ class VoteEditor(QWidget):
 
     def invalidVote(self):
         # with self.voteApp.appManager.mainManager.dbManager.dbClient:
-        self.voteApp.appManager.mainManager.dbManager.db.votes.addItem(
-            Vote(
-                valid=False,
-                vote_group=self.voteApp.appManager.mainManager.dbManager.db.voteGroups.getItem(
-                    self.groupSelector.currentIndex() + 1
-                ),
-            )
-        )  # Todo
+        with self.voteApp.appManager.mainManager.dbManager.db.do():
+            self.voteApp.appManager.mainManager.dbManager.db.votes.addItem(
+                Vote(
+                    valid=False,
+                    vote_group=self.voteApp.appManager.mainManager.dbManager.db.voteGroups.getItem(
+                        self.groupSelector.currentIndex() + 1
+                    ),
+                )
+            )  # Todo
         self.clear()
 
     def validate(self, vote):
@@ -322,7 +325,13 @@ class VoteApp(App):
         App.__init__(self, appManager, App.Tab, windowTitle="Vote App")
         self.uiWrapper = QtModelWrapper(self.appManager.mainManager.dbManager.db.votes)
         # self.uiWrapper.setModelAccessClient(self.appManager.mainManager.dbManager.dbClient)
-        self.appManager.mainManager.dbManager.db.votes.addEventFilter(self.uiWrapper)
+        self.appManager.mainManager.dbManager.db.votes.addEventFilter(
+            CoalescingEventFilter(
+                self.appManager.mainManager.dbManager.db.votes,
+                self.uiWrapper,
+                lambda flush: QTimer.singleShot(0, flush),  # One batch of rows per event-loop turn
+            )
+        )
         self.containerView = ContainerView(self.appManager.mainManager.dbManager.db.votes, self.uiWrapper)
         self.statView = StatView(self.appManager.mainManager)
         self.keyAssignmentEditor = KeyAssignmentEditor(self.appManager.mainManager, "Assigned keys:")
@@ -379,13 +388,14 @@ class SetupApp(App):
         # diff = partic_before.difference(partic_after)
         # if diff:
         #     self.appManager.mainManager.dbManager.db.participants.addItems()
-        self.appManager.mainManager.dbManager.db.participants.clear()
-        self.appManager.mainManager.dbManager.db.participants.addItems(
-            Participant(name=name) for name in self.participantList.allItems()
-        )
-        self.appManager.mainManager.dbManager.db.voteGroups.clear()
-        self.appManager.mainManager.dbManager.db.voteGroups.addItems(
-            VoteGroup(name=item) for item in self.groupList.allItems()
-        )
+        with self.appManager.mainManager.dbManager.db.do():
+            self.appManager.mainManager.dbManager.db.participants.clear()
+            self.appManager.mainManager.dbManager.db.participants.addItems(
+                Participant(name=name) for name in self.participantList.allItems()
+            )
+            self.appManager.mainManager.dbManager.db.voteGroups.clear()
+            self.appManager.mainManager.dbManager.db.voteGroups.addItems(
+                VoteGroup(name=item) for item in self.groupList.allItems()
+            )
         self.quit()
         self.appManager.voteApp()
@@ -9,11 +9,12 @@ class DbManager(Section):
     def __init__(self, mainManager):
         Section.__init__(self)
         self.mainManager = mainManager
+        # No group commit: a ballot has to be on disk when VoteEditor.save returns (see the durable-entry preset)
         self.db = ElectionDb(engine=SqliteEngine())
         self.keyAssignments = {}
 
     def generate_report(self):
-        points, topVotes, voteCount, invalidVotes = self.db.calcPoints()
+        points, topVotes, voteCount, invalidVotes = self.db.readTally()
         sum_points = sum(points.values())
         points = collections.OrderedDict(sorted(points.items(), key=lambda i: i[1], reverse=True))
         print(30 * "-")
@@ -67,7 +68,9 @@ class DbManager(Section):
         # 	os.remove("election.db")
         # except FileNotFoundError:
         # 	pass
-        self.db.open("election.db")
+        self.db.open("election.db", preset="durable-entry")
+        self.db.enableTally()  # The results are read from the tally, kept up to date by the database
+        self.db.commit()
         # self.db.open("/home/peter/Schule/Sonstiges/Schulsprecherwahl/2015⁄16/election_for_new_system.db")
         # self.dbClient=self.db.createClient()
         # with self.dbClient:
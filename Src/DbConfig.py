@@ -16,13 +16,16 @@ class VoteGroup(Entity):
 
 
 class Vote(Entity):
-    vote1 = ReferenceAttribute(Participant)  # 6 Points
-    vote2 = ReferenceAttribute(Participant)  # 5 Points
-    vote3 = ReferenceAttribute(Participant)  # etc.
-    vote4 = ReferenceAttribute(Participant)
-    vote5 = ReferenceAttribute(Participant)
-    vote6 = ReferenceAttribute(Participant)
-    vote_group = ReferenceAttribute(VoteGroup)
+    # Covering the per-rank counts of ElectionDb.calcPoints (see ItemContainer.rankCounts)
+    __indexes__ = tuple(("valid", "vote{}".format(rank)) for rank in range(1, 7))
+
+    vote1 = ReferenceAttribute(Participant, lazy=True)  # 6 Points
+    vote2 = ReferenceAttribute(Participant, lazy=True)  # 5 Points
+    vote3 = ReferenceAttribute(Participant, lazy=True)  # etc.
+    vote4 = ReferenceAttribute(Participant, lazy=True)
+    vote5 = ReferenceAttribute(Participant, lazy=True)
+    vote6 = ReferenceAttribute(Participant, lazy=True)
+    vote_group = ReferenceAttribute(VoteGroup, lazy=True, index=True)
     valid = BoolAttribute(True)
 
     def __str__(self):
@@ -30,13 +33,59 @@ class Vote(Entity):
 
 
 class ElectionDb(Database):
+    ranks = (Vote.vote1, Vote.vote2, Vote.vote3, Vote.vote4, Vote.vote5, Vote.vote6)
+
     def __init__(self, engine=None):
         Database.__init__(self, engine)
         self.participants = self.registerEntity(Participant)
+        self.participants.enableCache()
         self.voteGroups = self.registerEntity(VoteGroup)
+        self.voteGroups.enableCache()
         self.votes = self.registerEntity(Vote)
 
     def calcPoints(self):
+        if not self.votes.supportsRankCounts:  # The engine can't do it in a single query
+            return self._calcPointsPython()
+        return self._pointsFromCounts(*self.votes.rankCounts(self.ranks, Vote.valid))
+
+    def enableTally(self):
+        """Keeps the tally stored in the database, so readTally() doesn't have to scan the votes
+
+        :return: True if the tally was created newly, None if the engine can't store it
+        """
+        if not self.votes.supportsMaterializedRankCounts:
+            return None
+        return self.votes.materializeRankCounts(self.ranks, Vote.valid)
+
+    def readTally(self):
+        """Like calcPoints, but reads the stored tally (see enableTally) in O(participants)
+
+        Falls back to calcPoints if the tally isn't stored.
+        """
+        stored = self.votes.readRankCounts()
+        if stored is None:
+            return self.calcPoints()
+        return self._pointsFromCounts(*stored)
+
+    def checkTally(self):
+        """Rebuilds the stored tally from the votes
+
+        :return: the differences found, {(rank, participantId): (stored, actual)}; rank 0 counts the
+            invalid (participantId 0) and valid (1) votes. Empty if the tally was consistent,
+            None if there is no stored tally (see enableTally).
+        """
+        return self.votes.rebuildRankCounts()
+
+    def _pointsFromCounts(self, counts, voteCount, invalidVotes):
+        points = {parti.id: 0 for parti in self.participants}
+        topVotes = {parti.id: {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0} for parti in self.participants}
+        maxP = min(6, len(self.participants))
+        for (rank, partiId), count in counts.items():
+            points[partiId] += (maxP + 1 - rank) * count
+            topVotes[partiId][rank] += count
+        return points, topVotes, voteCount, invalidVotes
+
+    def _calcPointsPython(self):
         points = {parti.id: 0 for parti in self.participants}
         points[-1] = 0
         # How many points each participant has (vote1: 6 points, vote2: 5 p.)
@@ -45,28 +94,30 @@ class ElectionDb(Database):
         # How many topVotes each participant has
         voteCount, invalidVotes = 0, 0
         maxP = min(6, len(self.participants))
-        for vote in self.votes:
-            if not vote.valid:
+        for vote1, vote2, vote3, vote4, vote5, vote6, valid in self.votes.select(
+            Vote.vote1, Vote.vote2, Vote.vote3, Vote.vote4, Vote.vote5, Vote.vote6, Vote.valid
+        ):  # Only the ids are needed
+            if not valid:
                 invalidVotes += 1
                 continue
-            if vote.vote1:
-                points[vote.vote1.id] += maxP
-                topVotes[vote.vote1.id][1] += 1
-            if vote.vote2:
-                points[vote.vote2.id] += maxP - 1
-                topVotes[vote.vote2.id][2] += 1
-            if vote.vote3:
-                points[vote.vote3.id] += maxP - 2
-                topVotes[vote.vote3.id][3] += 1
-            if vote.vote4:
-                points[vote.vote4.id] += maxP - 3
-                topVotes[vote.vote4.id][4] += 1
-            if vote.vote5:
-                points[vote.vote5.id] += maxP - 4
-                topVotes[vote.vote5.id][5] += 1
-            if vote.vote6:
-                points[vote.vote6.id] += maxP - 5
-                topVotes[vote.vote6.id][6] += 1
+            if vote1 is not None:
+                points[vote1] += maxP
+                topVotes[vote1][1] += 1
+            if vote2 is not None:
+                points[vote2] += maxP - 1
+                topVotes[vote2][2] += 1
+            if vote3 is not None:
+                points[vote3] += maxP - 2
+                topVotes[vote3][3] += 1
+            if vote4 is not None:
+                points[vote4] += maxP - 3
+                topVotes[vote4][4] += 1
+            if vote5 is not None:
+                points[vote5] += maxP - 4
+                topVotes[vote5][5] += 1
+            if vote6 is not None:
+                points[vote6] += maxP - 5
+                topVotes[vote6][6] += 1
             voteCount += 1
         del points[-1], topVotes[-1]
         return points, topVotes, voteCount, invalidVotes
@@ -0,0 +1,180 @@
+"""Micro-benchmarks of the database layer
+
+Run with: python bench_db.py
+"""
+
+import os
+import random
+import tempfile
+import threading
+import time
+
+from Database import core, tools
+from Database.engine.sqlite import SqliteEngine
+from Src.DbConfig import ElectionDb, Participant, Vote, VoteGroup
+
+REPEAT = 100000
+RANKS = ("vote1", "vote2", "vote3", "vote4", "vote5", "vote6")
+
+
+def _report(title, generic, generated):
+    print(
+        "{:<40} generic: {:.3f}s  generated: {:.3f}s  speedup: {:.2f}x".format(
+            title, generic, generated, generic / generated
+        )
+    )
+
+
+def benchEntityFastPaths(repeat=REPEAT):
+    """Compares the generated __init__/readItem/writeItem with the generic loops of AbstractEntity"""
+    print("Entity fast paths ({} runs each)".format(repeat))
+    genericInit = core.AbstractEntity.__init__
+    genericRead = core.AbstractEntity.readItem.__func__
+    genericWrite = core.AbstractEntity.writeItem.__func__
+    samples = (
+        (Participant, dict(id=1, name="Peter")),
+        (VoteGroup, dict(id=1, name="1a")),
+        (Vote, dict(id=1, vote1=1, vote2=2, vote3=3, vote4=4, vote5=5, vote6=6, vote_group=1, valid=True)),
+    )
+    for entityCls, kwargs in samples:
+        name = entityCls.__name__
+        _report(
+            name + ".__init__",
+            tools.measure(repeat, lambda: genericInit(entityCls.__new__(entityCls), **kwargs)),
+            tools.measure(repeat, lambda: entityCls(**kwargs)),
+        )
+        item = entityCls(**kwargs)
+        _report(
+            name + ".writeItem",
+            tools.measure(repeat, lambda: genericWrite(entityCls, bytearray(), item)),
+            tools.measure(repeat, lambda: entityCls.writeItem(bytearray(), item)),
+        )
+        data = bytearray()
+        entityCls.writeItem(data, item)
+        data = bytes(data)
+        _report(
+            name + ".readItem",
+            tools.measure(repeat, lambda: genericRead(entityCls, bytearray(data))),
+            tools.measure(repeat, lambda: entityCls.readItem(bytearray(data))),
+        )
+
+
+def createElectionDb(voteCount, participantCount=8, groupCount=20):
+    """Creates a temporary sqlite ElectionDb filled with random votes"""
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db = ElectionDb(engine=SqliteEngine())
+    db.open(path)
+    with db.do():
+        db.participants.addItems(Participant(name="P%d" % i) for i in range(participantCount))
+        db.voteGroups.addItems(VoteGroup(name="G%d" % i) for i in range(groupCount))
+    participants = list(db.participants.allItems())
+    groups = list(db.voteGroups.allItems())
+    with db.do():
+        db.votes.addItems(
+            Vote(vote_group=random.choice(groups), **dict(zip(RANKS, random.sample(participants, 6))))
+            for i in range(voteCount)
+        )
+    return db
+
+
+class StatementCounter(object):
+    """Counts the sql statements executed on the current thread's connection"""
+
+    def __init__(self, db):
+        self.db = db
+        self.count = 0
+
+    def _trace(self, statement):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        self.db.engine.connection.set_trace_callback(self._trace)
+        return self
+
+    def __exit__(self, *args):
+        self.db.engine.connection.set_trace_callback(None)
+
+
+def benchReferenceResolution(voteCount=10000):
+    """Statements and time needed to read all votes including their references"""
+    db = createElectionDb(voteCount)
+    with StatementCounter(db) as counter:
+        startTime = time.time()
+        for vote in db.votes.allItems():
+            pass
+        duration = time.time() - startTime
+    print("Reading {} votes: {} statements, {:.3f}s".format(voteCount, counter.count, duration))
+    db.close()
+
+
+def benchVoteInsert(voteCount=200):
+    """Statements needed per added vote (entered like VoteEditor.save does) for every write policy"""
+    db = createElectionDb(1)
+    refAttrs = [attr for attr in Vote.attributes.values() if isinstance(attr, core.ReferenceAttribute)]
+    defaultPolicies = [attr.writePolicy for attr in refAttrs]
+    for policy in core.ReferenceAttribute.writePolicies:
+        for attr in refAttrs:
+            attr.writePolicy = policy
+        with StatementCounter(db) as counter:
+            for i in range(voteCount):
+                participantIds = random.sample(range(1, 9), 6)
+                vote = Vote(
+                    vote_group=db.voteGroups.getItem(random.randint(1, 20)),
+                    **{rank: db.participants.getItem(pId) for rank, pId in zip(RANKS, participantIds)},
+                )
+                with db.do():
+                    db.votes.addItem(vote)
+        print("Adding a vote ({}): {:.1f} statements".format(policy, counter.count / voteCount))
+    for attr, policy in zip(refAttrs, defaultPolicies):
+        attr.writePolicy = policy
+    db.close()
+
+
+def benchAddItems(db, rowCount=100000, title="sqlite"):
+    """Time of one bulk addItems, while another thread keeps adding participants; checks the returned ids"""
+    stop = threading.Event()
+
+    def otherWriter():
+        while not stop.is_set():
+            with db.do():
+                db.participants.addItem(Participant(name="Other"))
+
+    writer = threading.Thread(target=otherWriter)
+    writer.start()
+    try:
+        first, second = list(db.participants.allItems())[:2]
+        votes = [Vote(vote1=first, vote2=second, valid=i % 10 != 0) for i in range(rowCount)]
+        startTime = time.time()
+        with db.do():
+            itemIds = db.votes.addItems(votes)
+        duration = time.time() - startTime
+    finally:
+        stop.set()
+        writer.join()
+    assert len(set(itemIds)) == rowCount
+    for itemId, vote in zip(itemIds[::997], votes[::997]):  # A sample, without resolving references
+        assert db.votes.getItem(itemId).valid == vote.valid
+    print("Adding {} votes at once ({}): {:.3f}s".format(rowCount, title, duration))
+
+
+def benchAddItemsEngines(rowCount=100000):
+    """benchAddItems on sqlite and, if QVC_BENCH_PGDATABASE names a database, on PostgreSQL"""
+    db = createElectionDb(0)
+    benchAddItems(db, rowCount)
+    db.close()
+    pgDatabase = os.environ.get("QVC_BENCH_PGDATABASE")
+    if pgDatabase:
+        from Database.engine.pgsqlengine import PgSqlEngine
+
+        db = ElectionDb(engine=PgSqlEngine())
+        db.open(pgDatabase, host=os.environ.get("QVC_BENCH_PGHOST", "localhost"))
+        benchAddItems(db, rowCount, "postgresql")
+        db.close()
+
+
+if __name__ == "__main__":
+    benchEntityFastPaths()
+    benchReferenceResolution()
+    benchVoteInsert()
+    benchAddItemsEngines()
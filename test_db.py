@@ -1,6 +1,10 @@
+import _thread
 import os
+import sqlite3
+import threading
 
-from Database.engine.sqlite import SqliteEngine
+from Database.core import makePredicate
+from Database.engine.sqlite import ConnectionPool, SqliteEngine
 from Src.DbConfig import *
 
 db_path = "election_new.db"
@@ -29,6 +33,216 @@ print(list(db.participants.allItems()))
 # print(list(allItems))
 # print(list(db.votes.engine.allItems()))
 print(db.votes.getItem(1).vote_group)
+
+# Lazy references compare equal to their items from both sides
+storedVote = db.votes.getItem(1)
+assert storedVote.vote1 == peter and peter == storedVote.vote1
+assert [konrad, peter].index(storedVote.vote1) == 1 and storedVote.vote2 in [konrad]
+assert peter != "Peter"
+
+# Keyset pages ordered by a nullable attribute: None first, no row skipped
+with db.do():
+    db.votes.addItems([Vote(vote1=None), Vote(vote1=konrad), Vote(vote1=None), Vote(vote1=peter)])
+pagedIds, cursor = [], None
+while True:
+    page = db.votes.page(cursor, limit=2, orderBy=Vote.vote1)
+    pagedIds += [item.id for item in page.items]
+    if page.cursor is None:
+        break
+    cursor = page.cursor
+assert pagedIds == [2, 4, 1, 5, 3], pagedIds
+assert list(db.votes.itemIds()) == [1, 2, 3, 4, 5]  # In id order, although indexes could cover the query
 print(list(db.votes.allItems()))
 
+# Expressions treat None like sql treats NULL, evaluated natively or in python
+storedVotes = list(db.votes.engine.allItems())
+for check in (Vote.vote1 != peter, Vote.vote1 < 5, ~(Vote.vote1 < 5), Vote.vote1 == None, ~Vote.vote1.isIn([peter])):
+    assert {item.id for item in db.votes.filterItems(check)} == {
+        item.id for item in storedVotes if makePredicate(check)(item)
+    }
+assert [item.id for item in db.votes.filterItems(Vote.vote1 != peter)] == [3]
+assert len(list(db.votes.filterItems(Vote.valid))) == len(storedVotes)  # A bare attribute as a condition
+assert list(db.votes.select(Vote.id, where=~Vote.valid)) == [] and db.votes.aggregate(where=Vote.valid)[0]["count"] == 5
+
+# filterItems has a cursor of its own: setting the items while iterating doesn't stop it early
+db.votes.refChunkSize = 2
+setCount = 0
+with db.do():
+    for item in db.votes.filterItems(Vote.valid):
+        item.markDirty()
+        db.votes.setItem(item)
+        setCount += 1
+assert setCount == len(storedVotes)
+del db.votes.refChunkSize
+
+
+# Transactions (Database.do): rollback, nested blocks as savepoints, group commit
+class Abort(Exception):
+    pass
+
+
+def voteIds():
+    return set(db.votes.itemIds())
+
+
+before = voteIds()
+try:
+    with db.do():
+        db.votes.addItem(Vote(vote1=peter))
+        raise Abort()
+except Abort:
+    pass
+assert voteIds() == before and len(db.votes) == len(before)
+
+with db.do():
+    outerId = db.votes.addItem(Vote(vote1=peter))
+    try:
+        with db.do():
+            innerId = db.votes.addItem(Vote(vote1=konrad))
+            raise Abort()
+    except Abort:
+        pass
+assert outerId in voteIds() and innerId not in voteIds()
+
+# A rolled back setItem leaves the item dirty, so setting it again still writes it
+renamed = db.participants.getItem(peter.id)
+renamed.name = "Pete"
+try:
+    with db.do():
+        db.participants.setItem(renamed)
+        raise Abort()
+except Abort:
+    pass
+assert db.participants.getItem(peter.id).name == "Peter" and renamed.isDirty()
+with db.do():
+    db.participants.setItem(renamed)
+assert db.participants.getItem(peter.id).name == "Pete" and not renamed.isDirty()
+renamed.name = "Peter"
+with db.do():  # The same for a savepoint, while its enclosing transaction is committed
+    try:
+        with db.do():
+            db.participants.setItem(renamed)
+            raise Abort()
+    except Abort:
+        pass
+assert db.participants.getItem(peter.id).name == "Pete" and renamed.isDirty()
+with db.do():
+    db.participants.setItem(renamed)
+assert db.participants.getItem(peter.id).name == "Peter" and not renamed.isDirty()
+
+
+# Bulk operations check all ids at once, a single ItemError lists every offending one
+def bulkItemErrorIds(operation, items):
+    try:
+        with db.do():
+            operation(items)
+    except ItemError as e:
+        return sorted(e.itemIds)
+    raise AssertionError("No ItemError raised")
+
+
+existingParticipants = sorted(db.participants.itemIds())
+newParticipants = [Participant(id=1), Participant(id=50), Participant(id=50), Participant(id=2)]
+assert bulkItemErrorIds(db.participants.insertItems, newParticipants) == [1, 2, 50]
+assert bulkItemErrorIds(db.participants.removeItems, [1, 60, 61]) == [60, 61]
+missingParticipants = [Participant(id=70), Participant(id=2), Participant(id=71)]
+assert bulkItemErrorIds(db.participants.setItems, missingParticipants) == [70, 71]
+assert sorted(db.participants.itemIds()) == existingParticipants  # Nothing was written
+
+# Connections of exited threads are given back, also for threads is_alive() keeps reporting alive (e.g. QThreads)
+pool = ConnectionPool(lambda: sqlite3.connect(":memory:", check_same_thread=False), maxSize=1, timeout=5.0)
+foreignThreadDone = threading.Event()
+
+
+def useConnection():
+    pool.get().execute("SELECT 1;")
+    foreignThreadDone.set()
+
+
+_thread.start_new_thread(useConnection, ())  # Not started by threading: seen as a _DummyThread
+foreignThreadDone.wait()
+pool.get()  # Would wait for the timeout and raise DatabaseError if the connection wasn't given back
+assert pool.stats()["reclaimed"] == 1 and pool.stats()["inUse"] == 1
+pool.closeAll()
+
+# The item cache (see ElectionDb) is shared by all threads: another thread's uncommitted change never leaves
+# a stale item in it
+nameChanged, nameRead = threading.Event(), threading.Event()
+
+
+def changeName():
+    with db.do():
+        item = db.participants.getItem(konrad.id)
+        item.name = "Konny"
+        db.participants.setItem(item)
+        nameChanged.set()
+        nameRead.wait()
+    db.engine.releaseConnection()
+
+
+writer = threading.Thread(target=changeName)
+writer.start()
+nameChanged.wait()
+assert db.participants.getItem(konrad.id).name == "Konrad"  # The committed version, which must not be cached
+nameRead.set()
+writer.join()
+assert db.participants.getItem(konrad.id).name == "Konny"
+
+db.setGroupCommit(maxOperations=3)
+with db.do():
+    firstId = db.votes.addItem(Vote())
+assert db.engine.connection.in_transaction  # Pending in its group
+try:
+    with db.do():
+        failedId = db.votes.addItem(Vote())
+        raise Abort()
+except Abort:
+    pass
+assert firstId in voteIds() and failedId not in voteIds()  # Only the failing block was rolled back
+with db.do():
+    db.votes.addItem(Vote())
+with db.do():
+    db.votes.addItem(Vote())
+assert not db.engine.connection.in_transaction  # The group of 3 was committed
+db.setGroupCommit()
+
+# The trigger-maintained tally (ElectionDb.enableTally) always matches a recount of the votes
+with db.do():
+    assert db.enableTally() is True
+assert db.readTally() == db._calcPointsPython() and db.checkTally() == {}
+
+
+def assertTallyConsistent():
+    assert db.readTally() == db._calcPointsPython()
+    assert db.checkTally() == {}
+
+
+with db.do():  # INSERT
+    tallyIds = db.votes.addItems([Vote(vote1=peter, vote2=konrad), Vote(vote1=konrad, valid=False), Vote(vote3=peter)])
+assertTallyConsistent()
+with db.do():  # Partial UPDATE OF a rank, and of the flag
+    vote = db.votes.getItem(tallyIds[0])
+    vote.vote1, vote.vote2 = konrad, peter
+    db.votes.setItem(vote)
+    vote = db.votes.getItem(tallyIds[1])
+    vote.valid = True
+    db.votes.setItem(vote)
+assertTallyConsistent()
+with db.do():  # Upsert of an existing and of a new vote
+    db.votes.upsertItems(Vote(id=tallyIds[2], vote1=peter, vote6=konrad), Vote(id=1000, vote2=peter))
+assertTallyConsistent()
+with db.do():  # DELETE
+    db.votes.removeItems([tallyIds[0], 1000])
+assertTallyConsistent()
+try:
+    with db.do():  # A failing bulk removal is rolled back together with its trigger updates
+        db.votes.removeItems([tallyIds[1], 123456])
+except ItemError:
+    pass
+assertTallyConsistent()
+db.engine.connection.execute("UPDATE votes_tally SET count = count + 5 WHERE rank = 1 AND value = ?;", (peter.id,))
+stored, actual = db.checkTally()[(1, peter.id)]
+assert stored == actual + 5 and db.checkTally() == {}  # Found, and repaired by the rebuild
+db.commit()
+
 db.close()